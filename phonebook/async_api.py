@@ -0,0 +1,273 @@
+""" Asyncio counterparts of the phonebook data layer, built on psycopg 3 and psycopg_pool.
+
+The sync functions in main.py keep using psycopg2; this module is only needed by
+services that embed the phonebook in an event loop (pip install "psycopg[pool]").
+"""
+import asyncio
+
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool
+from config import load_config
+from instrumentation import QueryTimer, settings as instrumentation_settings
+from pool import load_pool_config
+from cache import lookup_cache, invalidate, notify_payloads, NOTIFY_CHANNEL
+from phone_normalization import normalize_phone
+from storage import keyset_seek, row_key
+import read_model
+from main import (
+    PHONE_LOOKUP_QUERY, SURNAME_LOOKUP_QUERY, SELECT_QUERIES, KEYSET_QUERIES, INSERT_USERS_BATCH_SIZE, lookup_tags
+)
+
+_pools = {}
+_pools_lock = asyncio.Lock()
+
+
+def make_async_conninfo(config):
+    params = dict(config)
+    if 'database' in params:
+        params['dbname'] = params.pop('database')
+    return make_conninfo(**params)
+
+
+async def get_async_pool(config=None, pool_config=None):
+    """ Return the shared async pool for the given connection config, opening it on first use """
+    config = config if config is not None else load_config()
+    key = tuple(sorted(config.items()))
+    async with _pools_lock:
+        if key not in _pools:
+            pool_config = pool_config or load_pool_config()
+            pool = AsyncConnectionPool(
+                make_async_conninfo(config),
+                min_size=pool_config['minconn'],
+                max_size=pool_config['maxconn'],
+                timeout=pool_config['timeout'],
+                open=False
+            )
+            await pool.open()
+            _pools[key] = pool
+        return _pools[key]
+
+
+async def close_async_pools():
+    async with _pools_lock:
+        for pool in _pools.values():
+            await pool.close()
+        _pools.clear()
+
+
+async def finish_timer(timer, error=None):
+    """ Slow-query EXPLAINs run on a psycopg2 connection, so hooks leave the event loop when they can """
+    if instrumentation_settings['explain']:
+        await asyncio.to_thread(timer.finish, error)
+    else:
+        timer.finish(error)
+
+
+async def timed_execute(cur, query, args=(), config=None):
+    """ await cur.execute(query, args) as one timed statement, like instrumentation.timed_execute """
+    timer = QueryTimer(query, args, config)
+    try:
+        await cur.execute(query, args)
+    except Exception as e:
+        await finish_timer(timer, e)
+        raise
+    timer.mark('execute', rows=cur.rowcount)
+    await finish_timer(timer)
+
+
+async def publish_invalidation(cur, keys=(), tags=(), everything=False):
+    """ cache.publish_invalidation on an async cursor, so the NOTIFY commits or rolls back with the write """
+    if not lookup_cache.notify:
+        return
+    for payload in notify_payloads(keys, tags, everything):
+        await cur.execute('SELECT pg_notify(%s, %s)', (NOTIFY_CHANNEL, payload))
+
+
+async def execute_wrapper(query, *args, invalidation=None, config=None):
+    """ invalidation holds cache.invalidate keyword arguments for a write: published in its transaction,
+        applied to this process's cache once it has committed """
+    pool = await get_async_pool(config)
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await timed_execute(cur, query, args, config)
+            result = await cur.fetchall() if cur.description else None
+            if invalidation is not None:
+                await publish_invalidation(cur, **invalidation)
+    if invalidation is not None:
+        invalidate(**invalidation)
+    return result
+
+
+async def paginate_wrapper(query, limit, offset, *args, config=None):
+    PAGINATION_SUFFIX = 'LIMIT {limit} OFFSET {offset}'
+    limit, offset = int(limit), int(offset)
+    pool = await get_async_pool(config)
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            while True:
+                pagination = PAGINATION_SUFFIX.format(limit=limit, offset=offset)
+                await timed_execute(cur, query + ' ' + pagination, args, config)
+                result = await cur.fetchall()
+                if not result:
+                    break
+                yield result
+                offset += limit
+
+
+async def keyset_paginate_wrapper(query, mode, limit, *args, last_key=None, config=None):
+    pool = await get_async_pool(config)
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            while True:
+                seek, seek_args = keyset_seek(mode, last_key)
+                await timed_execute(cur, query.format(seek=seek) + ' LIMIT %s', args + seek_args + (limit,), config)
+                result = await cur.fetchall()
+                if not result:
+                    break
+                last_key = row_key(mode, result[-1])
+                yield result
+
+
+async def iterate_rows(pages):
+    """ Flatten an async page iterator into an async row iterator """
+    async for page in pages:
+        for row in page:
+            yield row
+
+
+async def insert_person(first_name, second_name, username, config=None):
+    query = """
+        INSERT INTO persons (first_name, second_name, username)
+        VALUES (%s, %s, %s)
+        RETURNING id
+    """
+    result = await execute_wrapper(
+        query, first_name, second_name, username, invalidation={'keys': [('surname', second_name)]}, config=config
+    )
+    return result[0][0]
+
+
+async def insert_phone(phone, person_id, config=None):
+    query = """
+        INSERT INTO phones (phone, person_id)
+        VALUES (%s, %s)
+        RETURNING phone_id
+    """
+    result = await execute_wrapper(
+        query, phone, person_id, invalidation={'keys': [('phone', normalize_phone(phone))]}, config=config
+    )
+    return result[0][0]
+
+
+async def insert_users(users, batch_size=INSERT_USERS_BATCH_SIZE, config=None):
+    """ Insert (first_name, second_name, username, phone) tuples, one multi-row statement per batch """
+    users = list(users)
+    inserted = 0
+    pool = await get_async_pool(config)
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            for start in range(0, len(users), batch_size):
+                batch = users[start:start + batch_size]
+                await timed_execute(
+                    cur,
+                    """
+                    WITH data AS (
+                        SELECT * FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[], %s::varchar[])
+                            AS t (fname, sname, username, phone)
+                    ), inserted AS (
+                        INSERT INTO persons (first_name, second_name, username)
+                        SELECT fname, sname, username FROM data
+                        RETURNING id, username
+                    )
+                    INSERT INTO phones (phone, person_id)
+                    SELECT data.phone, inserted.id
+                    FROM data JOIN inserted ON inserted.username = data.username
+                    """,
+                    [list(column) for column in zip(*batch)],
+                    config
+                )
+                inserted += cur.rowcount
+            await publish_invalidation(cur, everything=True)
+    invalidate(everything=True)
+    return inserted
+
+
+async def update_person(person_id, config=None, **values):
+    columns = [column for column in ('first_name', 'second_name', 'username') if values.get(column)]
+    if not columns:
+        return
+    query = f"UPDATE persons SET {', '.join(f'{column} = %s' for column in columns)} WHERE id = %s"
+    invalidation = {'keys': [('surname', values.get('second_name'))], 'tags': [('person', int(person_id))]}
+    await execute_wrapper(
+        query, *[values[column] for column in columns], person_id, invalidation=invalidation, config=config
+    )
+
+
+async def update_phone(phone_id, phone, person_id=None, config=None):
+    updates, args = ['phone = %s'], [phone]
+    if person_id:
+        updates.append('person_id = %s')
+        args.append(person_id)
+    query = f"UPDATE phones SET {', '.join(updates)} WHERE phone_id = %s"
+    invalidation = {'keys': [('phone', normalize_phone(phone))], 'tags': [('phone_id', int(phone_id))]}
+    await execute_wrapper(query, *args, phone_id, invalidation=invalidation, config=config)
+
+
+async def delete_person(person_id, config=None):
+    await execute_wrapper(
+        'DELETE FROM persons WHERE id = %s', person_id, invalidation={'tags': [('person', int(person_id))]}, config=config
+    )
+
+
+async def delete_phone(phone_id, config=None):
+    await execute_wrapper(
+        'DELETE FROM phones WHERE phone_id = %s', phone_id, invalidation={'tags': [('phone_id', int(phone_id))]},
+        config=config
+    )
+
+
+async def cached_lookup(key, query, value, config=None):
+    rows = lookup_cache.get(key)
+    if rows is None:
+        generation = lookup_cache.generation
+        rows = await execute_wrapper(query, value, config=config)
+        lookup_cache.put(key, rows, lookup_tags(rows), generation)
+    return rows
+
+
+async def lookup_by_phone(phone, config=None):
+    return await cached_lookup(('phone', normalize_phone(phone)), PHONE_LOOKUP_QUERY, phone, config=config)
+
+
+async def lookup_by_surname(surname, config=None):
+    return await cached_lookup(('surname', surname), SURNAME_LOOKUP_QUERY, surname, config=config)
+
+
+async def ensure_fresh(mode, config=None):
+    """ Apply pending person_phones changes before a PwP read; the refresh itself runs on psycopg2 """
+    if mode == 'PwP':
+        await asyncio.to_thread(read_model.ensure_fresh, config=config if config is not None else load_config())
+
+
+async def select_data(mode, value=None, config=None):
+    await ensure_fresh(mode, config)
+    if mode == 'PhN':
+        return await lookup_by_phone(value, config=config)
+    if mode == 'SurN':
+        return await lookup_by_surname(value, config=config)
+    if mode == 'PaN':
+        return await execute_wrapper(SELECT_QUERIES['PaN'], f'%{value}%', config=config)
+    return await execute_wrapper(SELECT_QUERIES[mode], config=config)
+
+
+async def select_pages(mode, limit, value=None, config=None):
+    """ Async iterator over keyset-paginated pages of a select_data mode """
+    args = ()
+    if mode == 'PaN':
+        args = (f'%{value}%',)
+    elif mode not in ('ALL', 'PwP'):
+        args = (value,)
+    await ensure_fresh(mode, config)
+    pages = keyset_paginate_wrapper(KEYSET_QUERIES[mode], mode, limit, *args, config=config)
+    async for page in pages:
+        yield page
@@ -0,0 +1,218 @@
+""" Run phonebook operations from a JSON Lines stream, one result line per operation.
+
+Each input line is an object with an "op" key:
+    {"op": "insert", "table": "persons", "values": {"first_name": "John", "second_name": "Doe", "username": "jd"}}
+    {"op": "update", "table": "phones", "id": 3, "values": {"phone": "555-0000"}}
+    {"op": "delete", "table": "persons", "id": 5}
+    {"op": "select", "mode": "PhN", "value": "555-1234"}
+    {"op": "select", "mode": "PwP", "limit": 100}
+    {"op": "procedure", "name": "UU", "args": ["John", "Doe", "jd", "555-1234"]}
+    {"op": "delete_many", "kind": "persons_by_phone", "values": ["555-1234", "555-5678"]}
+
+Usage: python batch.py [ops.jsonl] [--output results.jsonl] [--batch-size 1000]
+"""
+import argparse
+import json
+import sys
+from itertools import islice
+
+import psycopg2.extras
+from config import load_config
+from pool import get_pool
+from instrumentation import timed_execute
+from main import (
+    procedure_queries, INSERT_USERS_QUERY, SELECT_QUERIES, BULK_QUERIES, invalidate_lookups
+)
+from phone_normalization import normalize_phone
+import read_model
+
+BATCH_SIZE = 1000
+
+TABLES = {
+    'persons': ('id', ('first_name', 'second_name', 'username')),
+    'phones': ('phone_id', ('phone', 'person_id')),
+}
+
+
+class OperationError(Exception):
+    pass
+
+
+def table_columns(op, values):
+    if op.get('table') not in TABLES:
+        raise OperationError(f"Unknown table {op.get('table')!r}")
+    key, allowed = TABLES[op['table']]
+    unknown = set(values) - set(allowed)
+    if unknown:
+        raise OperationError(f"Unknown columns for {op['table']}: {', '.join(sorted(unknown))}")
+    return key, list(values)
+
+
+def run_insert(cur, op):
+    values = op.get('values') or {}
+    key, columns = table_columns(op, values)
+    if not columns:
+        raise OperationError('Nothing to insert')
+    timed_execute(
+        cur,
+        f"INSERT INTO {op['table']} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) RETURNING {key}",
+        [values[column] for column in columns]
+    )
+    return {key: cur.fetchone()[0]}
+
+
+def run_update(cur, op):
+    values = op.get('values') or {}
+    key, columns = table_columns(op, values)
+    if not columns:
+        raise OperationError('Nothing to update')
+    timed_execute(
+        cur,
+        f"UPDATE {op['table']} SET {', '.join(f'{column} = %s' for column in columns)} WHERE {key} = %s",
+        [values[column] for column in columns] + [op['id']]
+    )
+    return {'rowcount': cur.rowcount}
+
+
+def run_delete(cur, op):
+    key, _ = table_columns(op, {})
+    timed_execute(cur, f"DELETE FROM {op['table']} WHERE {key} = %s", (op['id'],))
+    return {'rowcount': cur.rowcount}
+
+
+def run_select(cur, op):
+    mode = op.get('mode')
+    if mode not in SELECT_QUERIES:
+        raise OperationError(f'Unknown select mode {mode!r}')
+    args = []
+    if mode == 'PwP':
+        read_model.ensure_fresh()
+    elif mode == 'PaN':
+        args.append(f"%{op['value']}%")
+    elif mode != 'ALL':
+        args.append(op['value'])
+    query = SELECT_QUERIES[mode]
+    if 'limit' in op:
+        query += ' LIMIT %s'
+        args.append(op['limit'])
+    timed_execute(cur, query, args)
+    return cur.fetchall()
+
+
+def run_procedure(cur, op):
+    name = op.get('name')
+    if name not in procedure_queries:
+        raise OperationError(f'Unknown procedure {name!r}')
+    if name == 'IM':
+        users = [tuple(user) for user in op['args']]
+        # One page, so rowcount covers every user rather than only the last page of 100
+        timed_execute(cur, INSERT_USERS_QUERY, run=lambda: psycopg2.extras.execute_values(
+            cur, INSERT_USERS_QUERY, users, page_size=max(len(users), 1)
+        ))
+    else:
+        timed_execute(cur, procedure_queries[name], op.get('args', []))
+    return {'rowcount': cur.rowcount}
+
+
+def run_delete_many(cur, op):
+    query = BULK_QUERIES.get(f"delete_{op.get('kind')}")
+    if query is None:
+        raise OperationError(f"Unknown delete_many kind {op.get('kind')!r}")
+    values = op['values']
+    if op['kind'] == 'persons_by_phone':
+        values = [phone for phone in map(normalize_phone, values) if phone]
+    timed_execute(cur, query, (values,))
+    return {'rowcount': cur.rowcount}
+
+
+handlers = {
+    'insert': run_insert,
+    'update': run_update,
+    'delete': run_delete,
+    'select': run_select,
+    'procedure': run_procedure,
+    'delete_many': run_delete_many,
+}
+
+
+def run_operation(cur, op):
+    handler = handlers.get(op.get('op'))
+    if handler is None:
+        raise OperationError(f"Unknown op {op.get('op')!r}")
+    return handler(cur, op)
+
+
+def parse_lines(lines):
+    """ Yield (line_no, op, error) for every non-blank input line """
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            op = json.loads(line)
+            if not isinstance(op, dict):
+                raise ValueError('operation must be a JSON object')
+        except ValueError as e:
+            yield line_no, None, f'Invalid JSON: {e}'
+        else:
+            yield line_no, op, None
+
+
+def run_batch(conn, batch):
+    """ Run a batch in one transaction; if any op fails, replay it with a savepoint per op """
+    results = []
+    try:
+        with conn.cursor() as cur:
+            for line_no, op, error in batch:
+                if error:
+                    raise OperationError(error)
+                results.append({'line': line_no, 'ok': True, 'result': run_operation(cur, op)})
+        conn.commit()
+        return results
+    except Exception:
+        conn.rollback()
+
+    results = []
+    with conn.cursor() as cur:
+        for line_no, op, error in batch:
+            if error:
+                results.append({'line': line_no, 'ok': False, 'error': error})
+                continue
+            cur.execute('SAVEPOINT batch_op')
+            try:
+                result = run_operation(cur, op)
+            except Exception as e:
+                # Malformed ops raise TypeError, ValueError and the like; each fails only its own line
+                cur.execute('ROLLBACK TO SAVEPOINT batch_op')
+                results.append({'line': line_no, 'ok': False, 'error': str(e).strip() or repr(e)})
+            else:
+                cur.execute('RELEASE SAVEPOINT batch_op')
+                results.append({'line': line_no, 'ok': True, 'result': result})
+    conn.commit()
+    return results
+
+
+def run(lines, output, batch_size=BATCH_SIZE, config=load_config()):
+    operations = parse_lines(lines)
+    total = failed = 0
+    with get_pool(config).connection() as conn:
+        while batch := list(islice(operations, batch_size)):
+            results = run_batch(conn, batch)
+            if any(op and op.get('op') != 'select' for _, op, _ in batch):
+                invalidate_lookups(everything=True)
+            for result in results:
+                output.write(json.dumps(result, default=str) + '\n')
+            total += len(results)
+            failed += sum(not result['ok'] for result in results)
+    return total, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run phonebook operations from JSON Lines')
+    parser.add_argument('input', nargs='?', type=argparse.FileType('r'), default=sys.stdin)
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    cli_args = parser.parse_args()
+
+    total, failed = run(cli_args.input, cli_args.output, cli_args.batch_size)
+    print(f'{total} operations, {failed} failed', file=sys.stderr)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,403 @@
+""" Phonebook benchmark suite against a local PostgreSQL instance.
+
+WARNING: truncates the persons and phones tables of the configured database.
+
+Usage: python benchmark.py --persons 100000 [--iterations 200] [--output results.json] [--label name]
+                           [--backend postgresql|sqlite]
+
+--backend runs the portable workload through the StorageBackend interface, so both engines
+are measured on the same operations; without it the PostgreSQL-specific suite runs.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from config import load_config
+from generate_dataset import write_dataset
+from bulk_import import import_csv
+from parallel_import import import_parallel
+from main import (
+    database_init, execute_wrapper, paginate_wrapper, keyset_paginate_wrapper, copy_csv, insert_users,
+    lookup_by_phone, procedure_queries, SELECT_QUERIES, KEYSET_QUERIES, PostgresBackend
+)
+from sqlite_backend import SqliteBackend
+from storage import STORAGE_DEFAULTS
+from cache import lookup_cache
+import read_model
+
+PAGE_SIZE = 100
+PROCEDURE_BATCH_SIZE = 1000
+PARALLEL_WORKERS = (1, 2, 4, 8)
+
+
+def percentile(sorted_samples, q):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, max(0, round(q / 100 * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def summarize(samples, rows=None):
+    """ Latencies are reported in milliseconds, throughput per second of total measured time """
+    ordered = sorted(samples)
+    total = sum(samples)
+    summary = {
+        'count': len(samples),
+        'total_s': total,
+        'mean_ms': total / len(samples) * 1000 if samples else 0.0,
+        'min_ms': ordered[0] * 1000 if ordered else 0.0,
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p95_ms': percentile(ordered, 95) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'max_ms': ordered[-1] * 1000 if ordered else 0.0,
+        'ops_per_sec': len(samples) / total if total else 0.0,
+    }
+    if rows is not None:
+        summary['rows'] = rows
+        summary['rows_per_sec'] = rows / total if total else 0.0
+    return summary
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def measure(func, iterations):
+    return [timed(lambda: func(i))[0] for i in range(iterations)]
+
+
+def first_page(pages):
+    page = next(pages, [])
+    pages.close()
+    return page
+
+
+class PhonebookBenchmark:
+
+    def __init__(self, persons, iterations, seed=42, config=load_config()):
+        self.persons = persons
+        self.iterations = iterations
+        self.seed = seed
+        self.config = config
+        self.rng = random.Random(seed)
+        self.results = {}
+        self.data_dir = tempfile.mkdtemp(prefix='phonebook_bench_')
+        self.paths, self.phones = write_dataset(persons, self.data_dir, seed)
+        self.backend = PostgresBackend(config)
+
+    def reset(self):
+        execute_wrapper('TRUNCATE persons, phones RESTART IDENTITY CASCADE', config=self.config)
+        lookup_cache.clear()
+
+    def users(self):
+        """ One (first_name, second_name, username, phone) per person: usernames are unique """
+        users = {}
+        with open(self.paths['combined']) as f:
+            next(f)  # Skip header
+            for line in f:
+                user = tuple(line.rstrip('\n').split(','))
+                users.setdefault(user[2], user)
+        return list(users.values())
+
+    def sample_column(self, query, count):
+        rows = execute_wrapper(query, count, config=self.config)
+        return [row[0] for row in rows]
+
+    def bench_procedure_insert_many_users(self):
+        self.reset()
+        users = self.users()
+        batches = [users[i:i + PROCEDURE_BATCH_SIZE] for i in range(0, len(users), PROCEDURE_BATCH_SIZE)]
+        samples = [
+            timed(lambda: execute_wrapper(procedure_queries['IM'], batch, config=self.config))[0]
+            for batch in batches
+        ]
+        self.results['insert_many_users_procedure'] = summarize(samples, rows=len(users))
+
+    def bench_insert_users(self):
+        self.reset()
+        users = self.users()
+        elapsed, _ = timed(lambda: insert_users(users, config=self.config))
+        self.results['insert_users'] = summarize([elapsed], rows=len(users))
+
+    def bench_bulk_import(self):
+        self.reset()
+        rejects_path = self.paths['combined'] + '.rejected.csv'
+        elapsed, report = timed(lambda: import_csv(self.paths['combined'], rejects_path=rejects_path, config=self.config))
+        self.results['bulk_import_csv'] = summarize([elapsed], rows=report.rows_read)
+
+    def bench_parallel_import(self):
+        # Small chunks so that even modest datasets are split across every worker
+        chunk_bytes = max(64 * 1024, os.path.getsize(self.paths['combined']) // (max(PARALLEL_WORKERS) * 4))
+        for workers in PARALLEL_WORKERS:
+            self.reset()
+            elapsed, report = timed(lambda: import_parallel(
+                self.paths['combined'], workers, chunk_bytes, config=self.config
+            ))
+            summary = summarize([elapsed], rows=report.rows_read)
+            summary['copy_s'] = report.copy_elapsed
+            summary['merge_s'] = report.merge_elapsed
+            summary['workers'] = {
+                worker: {'rows': stats.rows, 'rows_per_sec': stats.rows_per_sec}
+                for worker, stats in report.workers.items()
+            }
+            self.results[f'parallel_import_{workers}_workers'] = summary
+
+    def bench_csv_copy(self):
+        self.reset()
+
+        def copy_both():
+            copy_csv(self.paths['persons'], 'person', config=self.config)
+            copy_csv(self.paths['phones'], 'phone', config=self.config)
+
+        elapsed, _ = timed(copy_both)
+        self.results['csv_copy'] = summarize([elapsed], rows=self.persons + self.phones)
+        execute_wrapper('ANALYZE persons; ANALYZE phones;', config=self.config)
+
+    def bench_selects(self):
+        phones = self.sample_column('SELECT phone FROM phones ORDER BY random() LIMIT %s', self.iterations)
+        surnames = self.sample_column('SELECT second_name FROM persons ORDER BY random() LIMIT %s', self.iterations)
+        names = self.sample_column('SELECT first_name FROM persons ORDER BY random() LIMIT %s', self.iterations)
+        pick = lambda values, i: values[i % len(values)]
+
+        elapsed, rows = timed(lambda: execute_wrapper(SELECT_QUERIES['ALL'], config=self.config))
+        self.results['select_ALL'] = summarize([elapsed], rows=len(rows))
+        self.results['select_PaN'] = summarize(measure(
+            lambda i: execute_wrapper(SELECT_QUERIES['PaN'], f'%{pick(names, i)[1:4]}%', config=self.config),
+            self.iterations
+        ))
+        self.results['select_PhN'] = summarize(measure(
+            lambda i: execute_wrapper(SELECT_QUERIES['PhN'], pick(phones, i), config=self.config),
+            self.iterations
+        ))
+        self.results['select_SurN'] = summarize(measure(
+            lambda i: execute_wrapper(SELECT_QUERIES['SurN'], pick(surnames, i), config=self.config),
+            self.iterations
+        ))
+        self.results['select_PhN_prepared'] = summarize(measure(
+            lambda i: execute_wrapper(SELECT_QUERIES['PhN'], pick(phones, i), prepare=True, config=self.config),
+            self.iterations
+        ))
+        self.results['select_SurN_prepared'] = summarize(measure(
+            lambda i: execute_wrapper(SELECT_QUERIES['SurN'], pick(surnames, i), prepare=True, config=self.config),
+            self.iterations
+        ))
+        for prepare in (False, True):
+            self.results['noop_update_prepared' if prepare else 'noop_update'] = summarize(measure(
+                lambda i: execute_wrapper(
+                    'UPDATE persons SET username = username WHERE id = %s', i + 1, prepare=prepare, config=self.config
+                ),
+                self.iterations
+            ))
+        lookup_cache.clear()
+        self.results['select_PhN_cached'] = summarize(measure(
+            lambda i: lookup_by_phone(pick(phones, i % 10), config=self.config),
+            self.iterations
+        ))
+
+    def bench_record_memory(self):
+        """ Peak Python memory per joined row: materialized tuples versus grouped records """
+        for name, load in (
+            ('tuples', lambda: list(self.backend.stream('ALL'))),
+            ('records', lambda: list(self.backend.records('ALL'))),
+        ):
+            tracemalloc.start()
+            elapsed, result = timed(load)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del result
+            summary = summarize([elapsed], rows=self.phones)
+            summary['peak_bytes_per_row'] = peak / self.phones if self.phones else 0.0
+            self.results[f'memory_ALL_{name}'] = summary
+
+    def bench_read_model(self):
+        """ Refresh costs of person_phones and reads from it versus the persons JOIN phones query """
+        elapsed, rebuilt = timed(lambda: read_model.refresh(full=True, config=self.config))
+        self.results['read_model_full_refresh'] = summarize([elapsed], rows=rebuilt)
+
+        ids = self.rng.sample(range(1, self.phones + 1), min(self.phones, self.iterations))
+        execute_wrapper(
+            'UPDATE phones SET phone = phone WHERE phone_id = ANY(%s)', ids, config=self.config
+        )
+        elapsed, rebuilt = timed(lambda: read_model.refresh(config=self.config))
+        self.results['read_model_incremental_refresh'] = summarize([elapsed], rows=rebuilt)
+
+        for mode in ('ALL', 'PwP'):
+            elapsed, rows = timed(lambda: sum(1 for _ in self.backend.records(mode)))
+            self.results[f'records_{mode}'] = summarize([elapsed], rows=rows)
+            self.results[f'paginate_keyset_{mode}'] = summarize(measure(
+                lambda i: first_page(self.backend.paginate(mode, PAGE_SIZE)), self.iterations
+            ), rows=PAGE_SIZE * self.iterations)
+
+    def bench_pagination(self):
+        query = SELECT_QUERIES['ALL']
+        for fraction in (0, 0.1, 0.5, 0.9):
+            offset = int(self.phones * fraction)
+            last_key = (int(self.persons * fraction), 0)
+            self.results[f'paginate_offset_{offset}'] = summarize(measure(
+                lambda i: first_page(paginate_wrapper(query, PAGE_SIZE, offset, config=self.config)),
+                self.iterations
+            ), rows=PAGE_SIZE * self.iterations)
+            self.results[f'paginate_keyset_{offset}'] = summarize(measure(
+                lambda i: first_page(keyset_paginate_wrapper(
+                    KEYSET_QUERIES['ALL'], 'ALL', PAGE_SIZE, last_key=last_key, config=self.config
+                )),
+                self.iterations
+            ), rows=PAGE_SIZE * self.iterations)
+
+    def bench_update_delete(self):
+        ids = self.rng.sample(range(1, self.persons + 1), min(self.persons, self.iterations * 2))
+        update_ids, delete_ids = ids[:len(ids) // 2], ids[len(ids) // 2:]
+        self.results['update_person'] = summarize(measure(
+            lambda i: execute_wrapper(
+                'UPDATE persons SET first_name = %s WHERE id = %s', f'Bench{i}', update_ids[i], config=self.config
+            ),
+            len(update_ids)
+        ))
+        self.results['delete_person'] = summarize(measure(
+            lambda i: execute_wrapper('DELETE FROM persons WHERE id = %s', delete_ids[i], config=self.config),
+            len(delete_ids)
+        ))
+
+    def run(self):
+        database_init(self.config)
+        self.bench_procedure_insert_many_users()
+        self.bench_insert_users()
+        self.bench_bulk_import()
+        self.bench_parallel_import()
+        self.bench_csv_copy()
+        self.bench_selects()
+        self.bench_record_memory()
+        self.bench_read_model()
+        self.bench_pagination()
+        self.bench_update_delete()
+        return self.results
+
+    def report(self, label=None):
+        return {
+            'label': label,
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'persons': self.persons,
+            'phones': self.phones,
+            'iterations': self.iterations,
+            'seed': self.seed,
+            'results': self.results,
+        }
+
+
+class BackendBenchmark(PhonebookBenchmark):
+    """ Same dataset and report, measured only through StorageBackend methods """
+
+    def __init__(self, backend, persons, iterations, seed=42, config=load_config()):
+        super().__init__(persons, iterations, seed, config)
+        self.backend.close()
+        self.backend = backend
+
+    def reset(self):
+        self.backend.reset()
+        lookup_cache.clear()
+
+    def bench_insert_users(self):
+        self.reset()
+        users = self.users()
+        elapsed, _ = timed(lambda: self.backend.insert_users(users))
+        self.results['insert_users'] = summarize([elapsed], rows=len(users))
+
+    def bench_bulk_import(self):
+        self.reset()
+        elapsed, report = timed(lambda: self.backend.import_csv(self.paths['combined']))
+        self.results['bulk_import_csv'] = summarize([elapsed], rows=report.rows_read)
+
+    def bench_csv_copy(self):
+        self.reset()
+
+        def copy_both():
+            self.backend.copy_csv(self.paths['persons'], 'person')
+            self.backend.copy_csv(self.paths['phones'], 'phone')
+
+        elapsed, _ = timed(copy_both)
+        self.results['csv_copy'] = summarize([elapsed], rows=self.persons + self.phones)
+
+    def bench_selects(self):
+        users = self.rng.sample(self.users(), min(self.persons, self.iterations))
+        pick = lambda column, i: users[i % len(users)][column]
+
+        elapsed, rows = timed(lambda: self.backend.select('ALL'))
+        self.results['select_ALL'] = summarize([elapsed], rows=len(rows))
+        self.results['select_PaN'] = summarize(measure(
+            lambda i: self.backend.select('PaN', pick(0, i)[1:4]), self.iterations
+        ))
+        self.results['select_PhN'] = summarize(measure(
+            lambda i: self.backend.select('PhN', pick(3, i)), self.iterations
+        ))
+        self.results['select_SurN'] = summarize(measure(
+            lambda i: self.backend.select('SurN', pick(1, i)), self.iterations
+        ))
+        elapsed, rows = timed(lambda: sum(1 for _ in self.backend.stream('ALL')))
+        self.results['stream_ALL'] = summarize([elapsed], rows=rows)
+
+    def bench_pagination(self):
+        for fraction in (0, 0.1, 0.5, 0.9):
+            offset = int(self.phones * fraction)
+            self.results[f'paginate_offset_{offset}'] = summarize(measure(
+                lambda i: first_page(self.backend.paginate('ALL', PAGE_SIZE, offset=offset)),
+                self.iterations
+            ), rows=PAGE_SIZE * self.iterations)
+
+    def bench_update_delete(self):
+        ids = self.rng.sample(range(1, self.persons + 1), min(self.persons, self.iterations * 2))
+        update_ids, delete_ids = ids[:len(ids) // 2], ids[len(ids) // 2:]
+        self.results['update_person'] = summarize(measure(
+            lambda i: self.backend.update_person(update_ids[i], first_name=f'Bench{i}'), len(update_ids)
+        ))
+        self.results['delete_person'] = summarize(measure(
+            lambda i: self.backend.delete_person(delete_ids[i]), len(delete_ids)
+        ))
+
+    def run(self):
+        self.backend.init()
+        self.bench_insert_users()
+        self.bench_bulk_import()
+        self.bench_csv_copy()
+        self.bench_selects()
+        self.bench_record_memory()
+        self.bench_pagination()
+        self.bench_update_delete()
+        return self.results
+
+    def report(self, label=None):
+        return {**super().report(label), 'backend': type(self.backend).__name__}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the phonebook against a local PostgreSQL')
+    parser.add_argument('--persons', type=int, default=10000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--label')
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    parser.add_argument('--backend', choices=('postgresql', 'sqlite'))
+    parser.add_argument('--sqlite-path', default=STORAGE_DEFAULTS['sqlite_path'])
+    cli_args = parser.parse_args()
+
+    if cli_args.backend == 'sqlite':
+        benchmark = BackendBenchmark(
+            SqliteBackend(cli_args.sqlite_path), cli_args.persons, cli_args.iterations, cli_args.seed
+        )
+    elif cli_args.backend == 'postgresql':
+        benchmark = BackendBenchmark(PostgresBackend(), cli_args.persons, cli_args.iterations, cli_args.seed)
+    else:
+        benchmark = PhonebookBenchmark(cli_args.persons, cli_args.iterations, cli_args.seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        benchmark.run()
+    json.dump(benchmark.report(cli_args.label), cli_args.output, indent=2)
+    cli_args.output.write('\n')
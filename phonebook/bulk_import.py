@@ -0,0 +1,181 @@
+import csv
+import io
+import time
+from dataclasses import dataclass, field
+
+from config import load_config
+from pool import get_pool
+from instrumentation import timed_execute
+from phone_normalization import normalize_phone
+
+IMPORT_COLUMNS = ('first_name', 'second_name', 'username', 'phone')
+COLUMN_LIMITS = {'first_name': 35, 'second_name': 35, 'username': 35, 'phone': 20}
+CHUNK_SIZE = 50000
+
+STAGING_DDL = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS import_staging (
+        line_no BIGINT NOT NULL,
+        first_name VARCHAR(35) NOT NULL,
+        second_name VARCHAR(35) NOT NULL,
+        username VARCHAR(35) NOT NULL,
+        phone VARCHAR(20) NOT NULL
+    );
+"""
+
+# Template for the per-run staging tables; import_chunk's is a temporary copy dropped at commit
+STAGING_TABLE = 'import_staging'
+CHUNK_STAGING = 'import_chunk_staging'
+
+STAGING_COPY = """
+    COPY {staging} (line_no, first_name, second_name, username, phone)
+    FROM STDIN WITH (FORMAT csv)
+"""
+
+# Rows whose phone is already taken, by a stored phone or an earlier staged line, are rejected
+# before any person is written, so a rejected row leaves no trace in persons
+REJECT_TAKEN_PHONES = """
+    DELETE FROM {staging} s
+    WHERE EXISTS (SELECT 1 FROM phones_matching(s.phone))
+    OR EXISTS (
+        SELECT 1 FROM {staging} earlier
+        WHERE normalize_phone(earlier.phone) = normalize_phone(s.phone) AND earlier.line_no < s.line_no
+    )
+    RETURNING s.line_no, s.first_name, s.second_name, s.username, s.phone
+"""
+
+UPSERT_PERSONS = """
+    INSERT INTO persons (first_name, second_name, username)
+    SELECT DISTINCT ON (username) first_name, second_name, username
+    FROM {staging}
+    ORDER BY username, line_no DESC
+    ON CONFLICT (username) DO UPDATE
+    SET first_name = EXCLUDED.first_name, second_name = EXCLUDED.second_name
+"""
+
+UPSERT_PHONES = """
+    WITH chosen AS (
+        SELECT DISTINCT ON (normalize_phone(s.phone)) s.line_no, s.phone, p.id AS person_id
+        FROM {staging} s
+        JOIN persons p ON p.username = s.username
+        ORDER BY normalize_phone(s.phone), s.line_no
+    ), inserted AS (
+        INSERT INTO phones (phone, person_id)
+        SELECT phone, person_id FROM chosen
+        ON CONFLICT (phone_normalized) DO NOTHING
+        RETURNING phone
+    )
+    SELECT s.line_no, s.first_name, s.second_name, s.username, s.phone
+    FROM {staging} s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM chosen c JOIN inserted i ON i.phone = c.phone
+        WHERE c.line_no = s.line_no
+    )
+    ORDER BY s.line_no
+"""
+
+
+@dataclass
+class ImportReport:
+    rows_read: int = 0
+    rows_imported: int = 0
+    rows_rejected: int = 0
+    chunks: int = 0
+    elapsed: float = 0.0
+    rejects_path: str = None
+    errors: list = field(default_factory=list)
+
+    @property
+    def rows_per_sec(self):
+        return self.rows_read / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f'Read {self.rows_read} rows in {self.chunks} chunks, imported {self.rows_imported}, '
+            f'rejected {self.rows_rejected} in {self.elapsed:.2f}s ({self.rows_per_sec:.0f} rows/sec)'
+        )
+
+
+def validate_row(row):
+    """ Return a rejection reason for the row, or None if it can be staged """
+    if len(row) != len(IMPORT_COLUMNS):
+        return f'expected {len(IMPORT_COLUMNS)} fields, got {len(row)}'
+    for column, value in zip(IMPORT_COLUMNS, row):
+        if not value:
+            return f'{column} is empty'
+        if len(value) > COLUMN_LIMITS[column]:
+            return f'{column} is longer than {COLUMN_LIMITS[column]} characters'
+    if normalize_phone(row[IMPORT_COLUMNS.index('phone')]) is None:
+        return 'phone has no digits'
+    return None
+
+
+def read_chunks(f, chunk_size=CHUNK_SIZE):
+    """ Yield (staged_rows, rejected_rows) per chunk; rows carry their 1-based file line number """
+    reader = csv.reader(f)
+    next(reader, None)  # Skip header
+    staged, rejected = [], []
+    for row in reader:
+        line_no = reader.line_num
+        row = [value.strip() for value in row]
+        reason = validate_row(row)
+        if reason:
+            rejected.append((line_no, *row, reason))
+        else:
+            staged.append((line_no, *row))
+        if len(staged) + len(rejected) >= chunk_size:
+            yield staged, rejected
+            staged, rejected = [], []
+    if staged or rejected:
+        yield staged, rejected
+
+
+def copy_rows(cur, sql, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    timed_execute(cur, sql, run=lambda: cur.copy_expert(sql, buffer))
+
+
+def merge_staging(cur, staging=STAGING_TABLE):
+    """ Upsert staged rows into persons/phones; returns the rows whose phone was already taken.
+        Those are removed from staging first; UPSERT_PHONES still reports any a concurrent insert took """
+    timed_execute(cur, REJECT_TAKEN_PHONES.format(staging=staging))
+    taken = cur.fetchall()
+    timed_execute(cur, UPSERT_PERSONS.format(staging=staging))
+    timed_execute(cur, UPSERT_PHONES.format(staging=staging))
+    return [(*row, 'duplicate phone') for row in taken + cur.fetchall()]
+
+
+def import_chunk(rows, config=load_config()):
+    """ Stage one chunk and merge it into persons/phones in a single transaction.
+        The staging table is temporary, so concurrent imports never see each other's rows """
+    with get_pool(config).connection() as conn:
+        with conn.cursor() as cur:
+            timed_execute(cur, f'CREATE TEMPORARY TABLE {CHUNK_STAGING} (LIKE {STAGING_TABLE}) ON COMMIT DROP')
+            copy_rows(cur, STAGING_COPY.format(staging=CHUNK_STAGING), rows)
+            timed_execute(cur, f'ANALYZE {CHUNK_STAGING}')
+            conflicts = merge_staging(cur, CHUNK_STAGING)
+    return conflicts
+
+
+def import_csv(csv_path, chunk_size=CHUNK_SIZE, rejects_path=None, config=load_config()):
+    """ Import a combined first_name,second_name,username,phone CSV chunk by chunk """
+    report = ImportReport(rejects_path=rejects_path or csv_path + '.rejected.csv')
+    start = time.perf_counter()
+    with open(csv_path, 'r', newline='') as f, open(report.rejects_path, 'w', newline='') as rejects_file:
+        rejects = csv.writer(rejects_file)
+        rejects.writerow(('line_no', *IMPORT_COLUMNS, 'reason'))
+        for staged, rejected in read_chunks(f, chunk_size):
+            report.chunks += 1
+            report.rows_read += len(staged) + len(rejected)
+            if staged:
+                try:
+                    rejected += import_chunk(staged, config=config)
+                except Exception as e:
+                    report.errors.append(f'chunk {report.chunks}: {e}')
+                    rejected += [(*row, f'chunk failed: {e}') for row in staged]
+            rejects.writerows(sorted(rejected))
+            report.rows_rejected += len(rejected)
+    report.rows_imported = report.rows_read - report.rows_rejected
+    report.elapsed = time.perf_counter() - start
+    return report
@@ -0,0 +1,227 @@
+import json
+import select
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass, asdict
+
+import psycopg2
+from config import load_config, load_settings, default_filename
+
+CACHE_DEFAULTS = {
+    'max_entries': 10000,
+    'ttl': 60.0,
+    'notify': False,
+}
+NOTIFY_CHANNEL = 'phonebook_cache'
+# PostgreSQL rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7900
+# Seconds the listener waits before reconnecting, doubled per failed attempt up to the maximum
+LISTEN_RETRY_DELAY = 0.5
+LISTEN_RETRY_MAX_DELAY = 30.0
+
+
+class InvalidationError(Exception):
+    """ A write was committed, but its cache invalidation could not be published to other processes """
+
+
+def load_cache_config(filename=default_filename, section='cache'):
+    """ Read cache settings from the [cache] section, falling back to defaults """
+    return load_settings(CACHE_DEFAULTS, section, filename)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    expirations: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+    stale_loads: int = 0
+    listener_reconnects: int = 0
+
+    def snapshot(self):
+        stats = asdict(self)
+        lookups = self.hits + self.misses
+        stats['hit_ratio'] = self.hits / lookups if lookups else 0.0
+        return stats
+
+
+class LookupCache:
+    """ LRU cache with per-entry TTL; entries carry tags (e.g. ('person', id)) used for invalidation.
+
+    Every invalidation bumps generation. A loader reads it before querying and passes it to put(),
+    which drops the value if an invalidation landed in between, since the value may predate it.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60.0, notify=False):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.notify = notify
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._tags = defaultdict(set)
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            value, tags, expires_at = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def put(self, key, value, tags=(), generation=None):
+        tags = frozenset(tags)
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                self.stats.stale_loads += 1
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, tags, time.monotonic() + self.ttl)
+            for tag in tags:
+                self._tags[tag].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats.evictions += 1
+
+    def _remove(self, key):
+        _, tags, _ = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, keys=(), tags=()):
+        with self._lock:
+            doomed = {key for key in keys if key in self._entries}
+            for tag in tags:
+                doomed |= self._tags.get(tag, set())
+            for key in doomed:
+                self._remove(key)
+            self.stats.invalidations += len(doomed)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self.stats.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+            self.generation += 1
+
+    def lookup(self, key, loader, tags_of=lambda value: ()):
+        """ Return the cached value for key, loading and caching it on a miss """
+        value = self.get(key)
+        if value is None:
+            generation = self.generation
+            value = loader()
+            self.put(key, value, tags_of(value), generation)
+        return value
+
+
+lookup_cache = LookupCache(**load_cache_config())
+
+
+def _encode(items):
+    return [list(item) for item in items]
+
+
+def notify_payloads(keys=(), tags=(), everything=False, limit=NOTIFY_PAYLOAD_LIMIT):
+    """ Split an invalidation into JSON payloads of at most limit bytes each """
+    if everything:
+        yield json.dumps({'keys': [], 'tags': [], 'all': True})
+        return
+    empty = lambda: {'keys': [], 'tags': [], 'all': False}
+    payload, size = empty(), len(json.dumps(empty()))
+    for kind, item in [('keys', key) for key in _encode(keys)] + [('tags', tag) for tag in _encode(tags)]:
+        # json.dumps escapes non-ASCII, so characters are bytes; 2 more for the ", " separator
+        item_size = len(json.dumps(item)) + 2
+        if size + item_size > limit and (payload['keys'] or payload['tags']):
+            yield json.dumps(payload)
+            payload, size = empty(), len(json.dumps(empty()))
+        payload[kind].append(item)
+        size += item_size
+    if payload['keys'] or payload['tags']:
+        yield json.dumps(payload)
+
+
+def publish_invalidation(cur, keys=(), tags=(), everything=False):
+    """ Broadcast an invalidation to other processes; a no-op unless notify is enabled """
+    if not lookup_cache.notify:
+        return
+    for payload in notify_payloads(keys, tags, everything):
+        cur.execute('SELECT pg_notify(%s, %s)', (NOTIFY_CHANNEL, payload))
+
+
+def invalidate(cur=None, keys=(), tags=(), everything=False):
+    if everything:
+        lookup_cache.clear()
+    else:
+        lookup_cache.invalidate(keys, tags)
+    if cur is not None:
+        publish_invalidation(cur, keys, tags, everything)
+
+
+def _listen_once(config, stop):
+    """ LISTEN and apply invalidations until stop is set or the connection fails """
+    conn = psycopg2.connect(**config)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN {NOTIFY_CHANNEL};')
+        # Invalidations published while no one was listening are lost, so nothing cached can be trusted
+        lookup_cache.clear()
+        while not stop.is_set():
+            if select.select([conn], [], [], 1.0) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                payload = json.loads(conn.notifies.pop(0).payload)
+                if payload.get('all'):
+                    lookup_cache.clear()
+                else:
+                    lookup_cache.invalidate(
+                        [tuple(key) for key in payload.get('keys', [])],
+                        [tuple(tag) for tag in payload.get('tags', [])]
+                    )
+    finally:
+        conn.close()
+
+
+def _listen(config, stop):
+    delay = LISTEN_RETRY_DELAY
+    while not stop.is_set():
+        started = time.monotonic()
+        try:
+            _listen_once(config, stop)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            lookup_cache.clear()
+            lookup_cache.stats.listener_reconnects += 1
+            if time.monotonic() - started > LISTEN_RETRY_MAX_DELAY:
+                delay = LISTEN_RETRY_DELAY
+            print(f'Cache listener lost its connection ({e}); reconnecting in {delay:.1f}s')
+            stop.wait(delay)
+            delay = min(delay * 2, LISTEN_RETRY_MAX_DELAY)
+
+
+def start_listener(config=None):
+    """ Apply invalidations published by other processes in a background thread """
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=_listen, args=(config if config is not None else load_config(), stop),
+        name='phonebook-cache-listener', daemon=True
+    )
+    thread.start()
+    return stop
@@ -21,6 +21,26 @@ def load_config(filename=default_filename, section='postgresql'):
     return config
 
 
+def load_settings(defaults, section, filename=default_filename):
+    """ Read an optional section, converting values to the types of the defaults """
+    settings = dict(defaults)
+    try:
+        params = load_config(filename, section)
+    except Exception:
+        return settings
+
+    for key, default in defaults.items():
+        if key not in params:
+            continue
+        if isinstance(default, bool):
+            settings[key] = params[key].lower() in ('1', 'true', 'yes', 'on')
+        elif default is None:
+            settings[key] = params[key]
+        else:
+            settings[key] = type(default)(params[key])
+    return settings
+
+
 if __name__ == '__main__':
     print(default_filename)
     config = load_config()
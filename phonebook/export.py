@@ -0,0 +1,68 @@
+import gzip
+import time
+from dataclasses import dataclass
+
+from psycopg2.extensions import encodings
+from config import load_config
+from pool import get_pool
+from instrumentation import timed_execute
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+COPY_CSV = 'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)'
+# row_to_json escapes every control character, so with \x01/\x02 as quote and delimiter
+# COPY never quotes the line and each JSON object comes out verbatim on its own line
+COPY_JSONL = "COPY (SELECT row_to_json(export_row) FROM ({query}) AS export_row) TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+
+
+@dataclass
+class ExportReport:
+    path: str
+    rows: int = 0
+    bytes_written: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (
+            f'Exported {self.rows} rows ({self.bytes_written} bytes) to {self.path} '
+            f'in {self.elapsed:.2f}s ({self.rows_per_sec:.0f} rows/sec)'
+        )
+
+
+class CountingWriter:
+    """ Binary file wrapper handed to copy_expert; counts what COPY streams through it """
+
+    def __init__(self, f):
+        self.f = f
+        self.lines = 0
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.lines += data.count(b'\n')
+        self.bytes_written += len(data)
+        return self.f.write(data)
+
+
+def export_query(query, args, path, fmt='csv', compress=False, config=load_config()):
+    """ Stream the result of query through COPY TO STDOUT into a CSV or JSON Lines file, gzipped if asked """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format {fmt!r}, expected one of {", ".join(EXPORT_FORMATS)}')
+    report = ExportReport(path)
+    copy_sql = COPY_CSV if fmt == 'csv' else COPY_JSONL
+    start = time.perf_counter()
+    opener = gzip.open if compress else open
+    with opener(path, 'wb') as f, get_pool(config).connection() as conn:
+        with conn.cursor() as cur:
+            # COPY does not accept bind parameters, so they are inlined client-side
+            inlined = cur.mogrify(query, args).decode(encodings[conn.encoding])
+            writer = CountingWriter(f)
+            copy_query = copy_sql.format(query=inlined)
+            timed_execute(cur, copy_query, config=config, run=lambda: cur.copy_expert(copy_query, writer))
+    report.rows = writer.lines - (1 if fmt == 'csv' else 0)
+    report.bytes_written = writer.bytes_written
+    report.elapsed = time.perf_counter() - start
+    return report
@@ -0,0 +1,75 @@
+""" Deterministic synthetic phonebook data.
+
+Writes persons.csv (first_name,second_name,username), phones.csv (phone,person_id) in the
+same layout as csv_files/, and the combined persons_phones.csv used by bulk_import.
+person_id values assume the persons are loaded into an empty table with ids starting at 1.
+
+Usage: python generate_dataset.py 100000 --output-dir /tmp/phonebook_data [--seed 42]
+"""
+import argparse
+import csv
+import os
+import random
+
+FIRST_NAMES = [
+    'John', 'Jane', 'Michael', 'Emily', 'David', 'Sarah', 'James', 'Anna', 'Robert', 'Maria',
+    'Daniel', 'Laura', 'Aidar', 'Aruzhan', 'Timur', 'Dana', 'Alikhan', 'Amina', 'Nursultan', 'Aigerim',
+]
+SECOND_NAMES = [
+    'Doe', 'Smith', 'Johnson', 'Brown', 'Williams', 'Jones', 'Miller', 'Davis', 'Wilson', 'Moore',
+    'Taylor', 'Anderson', 'Akhmetov', 'Nurlanova', 'Seitkali', 'Bekova', 'Omarov', 'Zhumabek', 'Kim', 'Li',
+]
+MAX_PHONES_PER_PERSON = 3
+
+
+def generate_persons(count, seed=42):
+    """ Yield (first_name, second_name, username, phones) with unique usernames and phones """
+    rng = random.Random(seed)
+    phone_base = 70000000000
+    phone_no = 0
+    for person_id in range(1, count + 1):
+        first_name = rng.choice(FIRST_NAMES)
+        second_name = rng.choice(SECOND_NAMES)
+        username = f'{first_name[:3]}{second_name[:3]}{person_id}'.lower()
+        phones = []
+        for _ in range(rng.randint(1, MAX_PHONES_PER_PERSON)):
+            phones.append(str(phone_base + phone_no * 7919 % 10000000000))
+            phone_no += 1
+        yield first_name, second_name, username, phones
+
+
+def write_dataset(count, output_dir, seed=42):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {
+        'persons': os.path.join(output_dir, 'persons.csv'),
+        'phones': os.path.join(output_dir, 'phones.csv'),
+        'combined': os.path.join(output_dir, 'persons_phones.csv'),
+    }
+    phones_total = 0
+    with open(paths['persons'], 'w', newline='') as persons_file, \
+            open(paths['phones'], 'w', newline='') as phones_file, \
+            open(paths['combined'], 'w', newline='') as combined_file:
+        persons = csv.writer(persons_file)
+        phones = csv.writer(phones_file)
+        combined = csv.writer(combined_file)
+        persons.writerow(('first_name', 'second_name', 'username'))
+        phones.writerow(('phone', 'person_id'))
+        combined.writerow(('first_name', 'second_name', 'username', 'phone'))
+        for person_id, (first_name, second_name, username, person_phones) in enumerate(generate_persons(count, seed), 1):
+            persons.writerow((first_name, second_name, username))
+            for phone in person_phones:
+                phones.writerow((phone, person_id))
+                combined.writerow((first_name, second_name, username, phone))
+            phones_total += len(person_phones)
+    return paths, phones_total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a deterministic phonebook dataset')
+    parser.add_argument('count', type=int, help='number of persons')
+    parser.add_argument('--output-dir', default='bench_data')
+    parser.add_argument('--seed', type=int, default=42)
+    cli_args = parser.parse_args()
+
+    paths, phones_total = write_dataset(cli_args.count, cli_args.output_dir, cli_args.seed)
+    print(f'Wrote {cli_args.count} persons and {phones_total} phones to {cli_args.output_dir}')
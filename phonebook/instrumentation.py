@@ -0,0 +1,267 @@
+""" Per-statement latency histograms, counters and a slow-query log for the PostgreSQL data layer.
+
+Statements run through main's wrappers are timed by phase; other modules run theirs through
+timed_execute(). Every statement sent to PostgreSQL is recorded except the migrations run at startup,
+savepoint bookkeeping and the cache listener's LISTEN. async_api times its statements the same way.
+"""
+import bisect
+import json
+import re
+import threading
+import time
+from collections import defaultdict
+from functools import partial
+from datetime import datetime, timezone
+
+from config import load_settings
+from pool import get_pool
+
+INSTRUMENTATION_DEFAULTS = {
+    'enabled': True,
+    'slow_query_ms': 200.0,
+    'slow_query_log': 'slow_queries.log',
+    'explain': False,
+}
+# Upper bounds in seconds, Prometheus style; the implicit last bucket is +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_LABEL_LENGTH = 80
+WRITE_KEYWORDS = re.compile(r'\b(INSERT|UPDATE|DELETE|TRUNCATE|LOCK)\b', re.IGNORECASE)
+
+
+def statement_label(func_or_query):
+    """ A bounded metric label: the callable's name, or the SQL text with literals replaced by ? """
+    if callable(func_or_query):
+        while isinstance(func_or_query, partial):
+            func_or_query = func_or_query.func
+        return getattr(func_or_query, '__qualname__', type(func_or_query).__qualname__)
+    if isinstance(func_or_query, bytes):
+        func_or_query = func_or_query.decode()
+    query = re.sub(r"'(?:[^']|'')*'", '?', str(func_or_query))
+    query = re.sub(r'\b\d+(?:\.\d+)?\b', '?', query)
+    return re.sub(r'\s+', ' ', query).strip()[:STATEMENT_LABEL_LENGTH]
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        cumulative, total = {}, 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative['+Inf' if bound == float('inf') else str(bound)] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class QueryMetrics:
+    """ Per-statement, per-phase latency histograms plus call and row counters """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(Histogram)
+        self.calls = defaultdict(int)
+        self.rows = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.slow = defaultdict(int)
+
+    def record(self, event):
+        statement = event['statement']
+        with self._lock:
+            self.calls[statement] += 1
+            self.rows[statement] += max(event['rows'], 0)
+            if event['error']:
+                self.errors[statement] += 1
+            for phase, seconds in event['phases'].items():
+                self.latency[(statement, phase)].observe(seconds)
+            self.latency[(statement, 'total')].observe(event['total'])
+
+    def record_slow(self, statement):
+        with self._lock:
+            self.slow[statement] += 1
+
+    def snapshot(self):
+        with self._lock:
+            statements = {}
+            for statement, calls in self.calls.items():
+                statements[statement] = {
+                    'calls': calls,
+                    'rows': self.rows[statement],
+                    'errors': self.errors[statement],
+                    'slow': self.slow[statement],
+                    'latency': {
+                        phase: histogram.snapshot()
+                        for (label, phase), histogram in self.latency.items() if label == statement
+                    },
+                }
+            return {'timestamp': datetime.now(timezone.utc).isoformat(), 'statements': statements}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self, prefix='phonebook'):
+        escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+        lines = [
+            f'# TYPE {prefix}_query_seconds histogram',
+        ]
+        with self._lock:
+            for (statement, phase), histogram in sorted(self.latency.items()):
+                labels = f'statement="{escape(statement)}",phase="{phase}"'
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{prefix}_query_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_query_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'{prefix}_query_seconds_count{{{labels}}} {histogram.count}')
+            for name, counter in (('calls', self.calls), ('rows', self.rows), ('errors', self.errors), ('slow', self.slow)):
+                lines.append(f'# TYPE {prefix}_query_{name}_total counter')
+                for statement, value in sorted(counter.items()):
+                    lines.append(f'{prefix}_query_{name}_total{{statement="{escape(statement)}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class SlowQueryLog:
+    """ Appends JSON lines for statements slower than the threshold, optionally with their plan """
+
+    def __init__(self, path, threshold_ms, explain=False):
+        self.path = path
+        self.threshold = threshold_ms / 1000
+        self.explain = explain
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if event['total'] < self.threshold:
+            return
+        metrics.record_slow(event['statement'])
+        entry = {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'statement': event['statement'],
+            'query': event['query'],
+            'args': event['args'],
+            'total_ms': event['total'] * 1000,
+            'phases_ms': {phase: seconds * 1000 for phase, seconds in event['phases'].items()},
+            'rows': event['rows'],
+        }
+        if self.explain and is_read_only(event['query']):
+            entry['plan'] = explain_analyze(event['query'], event['args'], event['config'], event['conn'])
+        with self._lock, open(self.path, 'a') as f:
+            f.write(json.dumps(entry, default=str) + '\n')
+
+
+def is_read_only(query):
+    """ Whether EXPLAIN ANALYZE, which runs the statement, can repeat query without side effects """
+    if not isinstance(query, str) or not query.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return False
+    return WRITE_KEYWORDS.search(query) is None
+
+
+def explain_analyze(query, args, config, conn=None):
+    """ EXPLAIN on conn when the caller still holds one, inside a savepoint so its transaction is untouched;
+        borrowing a second pooled connection there could wait forever on a small pool """
+    try:
+        if conn is None:
+            with get_pool(config).connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, args)
+                    plan = [row[0] for row in cur.fetchall()]
+                conn.rollback()
+            return plan
+        with conn.cursor() as cur:
+            cur.execute('SAVEPOINT explain_analyze')
+            try:
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, args)
+                return [row[0] for row in cur.fetchall()]
+            finally:
+                cur.execute('ROLLBACK TO SAVEPOINT explain_analyze')
+    except Exception as e:
+        return [f'EXPLAIN failed: {e}']
+
+
+class QueryTimer:
+    """ Collects phase timings for one statement; call mark() after each phase and finish() once """
+
+    def __init__(self, func_or_query, args=(), config=None):
+        self.query = None if callable(func_or_query) else func_or_query
+        self.statement = statement_label(func_or_query)
+        self.args = args
+        self.config = config
+        self.phases = {}
+        self.rows = -1
+        self.start = self.last = time.perf_counter()
+
+    def executing(self, query, args=()):
+        """ Record the SQL actually sent, e.g. a page of the labelled query, for the slow-query log """
+        self.query = query
+        self.args = args
+
+    def resume(self):
+        """ Exclude the time since the last mark, e.g. spent by the consumer of a page or stream """
+        self.last = time.perf_counter()
+
+    def mark(self, phase, rows=None):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+        if rows is not None:
+            self.rows = rows
+
+    def finish(self, error=None, conn=None):
+        """ conn is the connection the statement ran on, when the caller still holds it """
+        if not settings['enabled']:
+            return
+        if error is not None:
+            self.mark('error')
+            error = repr(error)
+        event = {
+            'statement': self.statement,
+            'query': self.query,
+            'args': self.args,
+            'config': self.config,
+            'conn': conn,
+            'phases': self.phases,
+            'total': sum(self.phases.values()),
+            'rows': self.rows,
+            'error': error,
+        }
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception as e:
+                print(f'Instrumentation hook {hook!r} failed: {e}')
+
+
+settings = load_settings(INSTRUMENTATION_DEFAULTS, 'instrumentation')
+metrics = QueryMetrics()
+hooks = [metrics.record, SlowQueryLog(settings['slow_query_log'], settings['slow_query_ms'], settings['explain'])]
+
+
+def timed_execute(cur, query, args=(), config=None, run=None):
+    """ cur.execute(query, args) as one timed statement; run, when given, sends it instead (COPY, execute_values)
+        and its result is returned. Hooks get cur's connection, which the caller still holds """
+    timer = QueryTimer(query, args, config)
+    try:
+        result = cur.execute(query, args) if run is None else run()
+    except Exception as e:
+        timer.finish(error=e, conn=cur.connection)
+        raise
+    timer.mark('execute', rows=cur.rowcount)
+    timer.finish(conn=cur.connection)
+    return result
+
+
+def add_hook(hook):
+    """ Register a callable receiving one event dict per instrumented statement """
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
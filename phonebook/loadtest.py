@@ -0,0 +1,104 @@
+""" Concurrent load against a running service.py.
+
+Each worker thread loops over a mix of phone lookups (drawn from a small hot set, so concurrent
+identical lookups get coalesced) and single-user inserts (which the service micro-batches).
+Latency percentiles per operation and the service's coalescer/batcher counters are printed as JSON.
+
+Usage: python loadtest.py [--url http://127.0.0.1:8080] [--concurrency 32] [--requests 5000] [--insert-ratio 0.2]
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from urllib.parse import quote
+
+from benchmark import summarize
+
+HOT_PHONES = 50
+
+
+def request(url, method='GET', body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def hot_phones(url, count=HOT_PHONES):
+    status, page = request(f'{url}/persons?mode=ALL&limit={count}')
+    return [phone['phone'] for record in page.get('records', []) for phone in record['phones']]
+
+
+def run(url, concurrency, requests, insert_ratio, seed=42):
+    phones = hot_phones(url)
+    counter = iter(range(requests))
+    lock = threading.Lock()
+    samples = {'lookup': [], 'insert': []}
+    errors = {}
+
+    def worker(worker_id):
+        rng = random.Random(seed + worker_id)
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            if not phones or rng.random() < insert_ratio:
+                op = 'insert'
+                tag = uuid.uuid4().hex[:10]
+                call = lambda: request(f'{url}/users', 'POST', {
+                    'first_name': 'Load', 'second_name': 'Test', 'username': f'lt{tag}',
+                    'phone': str(rng.randrange(10**10, 10**11)),
+                })
+            else:
+                op = 'lookup'
+                call = lambda: request(f'{url}/lookup/phone/{quote(rng.choice(phones))}')
+            start = time.perf_counter()
+            status, _ = call()
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples[op].append(elapsed)
+                if status != 200:
+                    errors[status] = errors.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    _, stats = request(f'{url}/stats')
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'elapsed_s': elapsed,
+        'requests_per_sec': requests / elapsed if elapsed else 0.0,
+        'errors': errors,
+        'results': {op: summarize(values) for op, values in samples.items() if values},
+        'coalescer': stats.get('coalescer'),
+        'batcher': stats.get('batcher'),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the phonebook HTTP service')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--insert-ratio', type=float, default=0.2)
+    cli_args = parser.parse_args()
+
+    json.dump(
+        run(cli_args.url.rstrip('/'), cli_args.concurrency, cli_args.requests, cli_args.insert_ratio),
+        sys.stdout, indent=2
+    )
+    sys.stdout.write('\n')
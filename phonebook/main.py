@@ -1,111 +1,41 @@
 import psycopg2
 import psycopg2.extras
 import os
+import uuid
 from config import load_config
 from functools import partial
+from itertools import islice
+from pool import get_pool, pool_stats
+from bulk_import import import_csv
+from parallel_import import import_parallel
+from search import SEARCH_LIMIT, search_persons
+from migrations import migrate
+from export import EXPORT_FORMATS, export_query
+from instrumentation import QueryTimer, timed_execute, metrics as query_metrics
+from prepared import execute_prepared
+from phone_normalization import normalize_phone, backfill, backfill_pending
+from cache import lookup_cache, invalidate, publish_invalidation, start_listener, InvalidationError
+from storage import StorageBackend, SELECT_MODES, keyset_seek, row_key, load_storage_config
+from sqlite_backend import SqliteBackend
+from records import RECORD_ORDER, to_records
+import read_model
 
 CSV_BASE_PATH = os.path.join(os.path.dirname(__file__), "csv_files")
+STREAM_ITERSIZE = 2000
 
 
 def database_init(config):
-    commands = [
-        """
-        CREATE TABLE IF NOT EXISTS persons (
-            id SERIAL PRIMARY KEY,
-            first_name VARCHAR(35) NOT NULL,
-            second_name VARCHAR(35) NOT NULL,
-            username VARCHAR(35) NOT NULL UNIQUE
-        );
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS phones (
-            phone_id SERIAL PRIMARY KEY,
-            phone VARCHAR(20) NOT NULL UNIQUE,
-            person_id INTEGER,
-            FOREIGN KEY (person_id)
-            REFERENCES persons (id)
-            ON UPDATE CASCADE ON DELETE CASCADE
-        );
-        """,
-        """
-        CREATE OR REPLACE PROCEDURE add_update_user(
-            fname VARCHAR(35),
-            sname VARCHAR(35),
-            username VARCHAR(35),
-            phone VARCHAR(20)
-        )
-        LANGUAGE plpgsql
-        AS $$
-        DECLARE
-            personId INTEGER;
-        BEGIN
-            SELECT INTO personId FROM persons WHERE first_name = fname AND second_name = sname;
-            IF personId IS NULL
-                THEN
-                    INSERT INTO persons (first_name, second_name, username) VALUES (fname, sname, username) RETURNING id INTO personId;
-                    INSERT INTO phones (phone, person_id) VALUES (phone, personId);
-                ELSE
-                    UPDATE phones SET phone = phone WHERE person_id = personId;
-            END IF;
-        END;
-        $$;
-        """,
-        """
-        CREATE OR REPLACE PROCEDURE delete_by_phone_or_name(
-            method VARCHAR(2),
-            fname VARCHAR(35),
-            phone VARCHAR(20)
-        )
-        LANGUAGE plpgsql
-        AS $$
-        BEGIN
-            IF (method = 'ph' AND phone IS NOT NULL) THEN
-                    DELETE FROM persons WHERE id = (SELECT person_id from phones where phone = phone);
-            ELSIF (method = 'fn' AND fname IS NOT NULL) THEN
-                    DELETE FROM persons WHERE first_name = fname;
-            ELSE
-                RAISE NOTICE 'INVALID INPUT';
-            END IF;
-        END;
-        $$
-        """,
-        """
-            CREATE TYPE person_data AS (
-                fname VARCHAR(35),
-                sname VARCHAR(35),
-                username VARCHAR(35),
-                phone VARCHAR(20)
-            );
-            """,
-            """
-            CREATE OR REPLACE PROCEDURE insert_many_users(
-                persons_data person_data[]
-            )
-            LANGUAGE plpgsql
-            AS $$
-            DECLARE
-                rec person_data;
-                rec_id INTEGER;
-            BEGIN
-                FOREACH rec IN ARRAY persons_data
-                LOOP
-                    INSERT INTO persons (first_name, second_name, username)
-                    VALUES (rec.fname, rec.sname, rec.username) RETURNING id INTO rec_id;
-                    INSERT INTO phones (phone, person_id) VALUES (rec.phone, rec_id);
-                END LOOP;
-            END;
-            $$
-            """
-    ]
-
     try:
-        with psycopg2.connect(**config) as conn:
+        with get_pool(config).connection() as conn:
             print('Connected to the PostgreSQL server.')
-            with conn.cursor() as cur:
-                for command in commands:
-                    cur.execute(command)
-                conn.commit()
-            psycopg2.extras.register_composite("person_data", conn)
+            version = migrate(conn)
+            print(f'Database schema is at version {version}.')
+            psycopg2.extras.register_composite("person_data", conn, globally=True)
+        # Outside the migration's transaction: backfill() commits one short phone_id range at a time
+        if backfill_pending(config):
+            unresolved = backfill(config=config)
+            if unresolved:
+                print(f'{len(unresolved)} phones clash with a normalized number; run phone_normalization.py to list them')
 
     except (Exception, psycopg2.DatabaseError) as e:
         print(e)
@@ -114,40 +44,449 @@ def database_init(config):
 procedure_queries = {
     "UU": "CALL add_update_user(%s, %s, %s, %s);",
     "DD": "CALL delete_by_phone_or_name(%s, %s, %s);",
-    "IM": "CALL insert_many_users(%s);"
+    "IM": "CALL insert_many_users(%s::person_data[]);"
+}
+
+PHONE_LOOKUP_QUERY = """
+    SELECT * FROM persons
+    JOIN phones_matching(%s) AS phones on persons.id = phones.person_id
+"""
+SURNAME_LOOKUP_QUERY = "SELECT * FROM persons WHERE second_name = %s"
+
+SELECT_QUERIES = {
+    'ALL': "SELECT * FROM persons JOIN phones on persons.id = phones.person_id",
+    'PaN': "SELECT * FROM persons WHERE first_name LIKE %s",
+    'PhN': PHONE_LOOKUP_QUERY,
+    'SurN': SURNAME_LOOKUP_QUERY,
+    'PwP': "SELECT * FROM person_phones",
+}
+
+# SELECT_QUERIES with room for a storage.keyset_seek() predicate and the key order, for keyset pages
+KEYSET_QUERIES = {
+    'ALL': SELECT_QUERIES['ALL'] + ' WHERE {seek} ORDER BY persons.id, phones.phone_id',
+    'PaN': SELECT_QUERIES['PaN'] + ' AND {seek} ORDER BY id',
+    'PhN': PHONE_LOOKUP_QUERY + ' WHERE {seek} ORDER BY persons.id, phones.phone_id',
+    'SurN': SURNAME_LOOKUP_QUERY + ' AND {seek} ORDER BY id',
+    'PwP': SELECT_QUERIES['PwP'] + ' WHERE {seek} ORDER BY id',
+}
+
+INSERT_USERS_BATCH_SIZE = 10000
+INSERT_USERS_QUERY = """
+    WITH data (fname, sname, username, phone) AS (
+        VALUES %s
+    ), inserted AS (
+        INSERT INTO persons (first_name, second_name, username)
+        SELECT fname, sname, username FROM data
+        RETURNING id, username
+    )
+    INSERT INTO phones (phone, person_id)
+    SELECT data.phone, inserted.id
+    FROM data JOIN inserted ON inserted.username = data.username
+"""
+
+BULK_BATCH_SIZE = 10000
+# Bulk writes touching more ids than this invalidate the whole cache with one message instead of per-id tags
+BULK_INVALIDATION_TAGS = 100
+BULK_QUERIES = {
+    'delete_persons': "DELETE FROM persons WHERE id = ANY(%s::integer[])",
+    'delete_phones': "DELETE FROM phones WHERE phone_id = ANY(%s::integer[])",
+    'delete_persons_by_phone': """
+        DELETE FROM persons
+        WHERE id IN (SELECT person_id FROM unnest(%s::varchar[]) AS wanted (phone), phones_matching(wanted.phone))
+    """,
+    'delete_persons_by_first_name': "DELETE FROM persons WHERE first_name = ANY(%s::varchar[])",
+    'update_persons': """
+        UPDATE persons SET
+            first_name = COALESCE(data.first_name, persons.first_name),
+            second_name = COALESCE(data.second_name, persons.second_name),
+            username = COALESCE(data.username, persons.username)
+        FROM (VALUES %s) AS data (id, first_name, second_name, username)
+        WHERE persons.id = data.id
+    """,
+    'update_phones': """
+        UPDATE phones SET
+            phone = COALESCE(data.phone, phones.phone),
+            person_id = COALESCE(data.person_id, phones.person_id)
+        FROM (VALUES %s) AS data (phone_id, phone, person_id)
+        WHERE phones.phone_id = data.phone_id
+    """,
 }
 
 
 def paginate_wrapper(query, limit, offset, *args, config=load_config()):
     PAGINATION_SUFFIX = 'LIMIT {limit} OFFSET {offset}'
-    with psycopg2.connect(**config) as conn:
+    timer = QueryTimer(query, args, config)
+    with get_pool(config).connection() as conn:
+        timer.mark('connect')
         with conn.cursor() as cur:
             result = True
             while result:
-                pagination = PAGINATION_SUFFIX.format(limit=limit, offset=offset)
-                cur.execute(query + ' ' + pagination, args)
+                page_query = query + ' ' + PAGINATION_SUFFIX.format(limit=limit, offset=offset)
+                timer.executing(page_query, args)
+                cur.execute(page_query, args)
+                timer.mark('execute')
                 result = cur.fetchall()
+                timer.mark('fetch', rows=len(result))
+                timer.finish(conn=conn)
+                timer = QueryTimer(query, args, config)
                 if not result:
                     print('No more results')
                     break
                 yield result
+                timer.resume()
                 offset += limit
 
 
-def execute_wrapper(func_or_query, *args, config=load_config()):
-    with psycopg2.connect(**config) as conn:
+def keyset_paginate_wrapper(query, mode, limit, *args, last_key=None, config=load_config()):
+    """ Pages of a KEYSET_QUERIES query for a select mode, each starting after the previous page's last key """
+    timer = QueryTimer(query, args, config)
+    with get_pool(config).connection() as conn:
+        timer.mark('connect')
         with conn.cursor() as cur:
-            if callable(func_or_query):
-                result = func_or_query(cur)
-            else:
-                cur.execute(func_or_query, args)
-            try:
+            while True:
+                seek, seek_args = keyset_seek(mode, last_key)
+                page_query, page_args = query.format(seek=seek) + ' LIMIT %s', args + seek_args + (limit,)
+                timer.executing(page_query, page_args)
+                cur.execute(page_query, page_args)
+                timer.mark('execute')
                 result = cur.fetchall()
-            except:
-                result = None
-            conn.commit()
-            print('Changes committed')
-            return result
+                timer.mark('fetch', rows=len(result))
+                timer.finish(conn=conn)
+                timer = QueryTimer(query, args, config)
+                if not result:
+                    print('No more results')
+                    break
+                last_key = row_key(mode, result[-1])
+                yield result
+                timer.resume()
+
+
+def stream_wrapper(query, *args, itersize=STREAM_ITERSIZE, config=load_config()):
+    timer = QueryTimer(query, args, config)
+    fetched = 0
+    try:
+        with get_pool(config).connection() as conn:
+            timer.mark('connect')
+            with conn.cursor(name=f'stream_{uuid.uuid4().hex}') as cur:
+                cur.execute(query, args)
+                timer.mark('execute')
+                try:
+                    while rows := cur.fetchmany(itersize):
+                        fetched += len(rows)
+                        timer.mark('fetch', rows=fetched)
+                        yield from rows
+                        timer.resume()
+                except GeneratorExit:
+                    # Closed early by its consumer
+                    timer.finish(conn=conn)
+                    raise
+                timer.finish(conn=conn)
+    except Exception as e:
+        timer.finish(error=e)
+        raise
+
+
+def execute_wrapper(func_or_query, *args, prepare=False, config=load_config()):
+    timer = QueryTimer(func_or_query, args, config)
+    try:
+        with get_pool(config).connection() as conn:
+            timer.mark('connect')
+            with conn.cursor() as cur:
+                if callable(func_or_query):
+                    result = func_or_query(cur)
+                elif prepare:
+                    execute_prepared(cur, func_or_query, args)
+                else:
+                    cur.execute(func_or_query, args)
+                timer.mark('execute')
+                try:
+                    result = cur.fetchall()
+                except:
+                    result = None
+                timer.mark('fetch', rows=len(result) if result is not None else cur.rowcount)
+                conn.commit()
+                timer.mark('commit')
+                print('Changes committed')
+    except Exception as e:
+        timer.finish(error=e)
+        raise
+    timer.finish()
+    return result
+
+
+def lookup_tags(rows):
+    tags = {('person', row[0]) for row in rows}
+    tags.update(('phone_id', row[4]) for row in rows if len(row) > 4)
+    return tags
+
+
+def lookup_by_phone(phone, config=load_config()):
+    loader = partial(execute_wrapper, PHONE_LOOKUP_QUERY, phone, prepare=True, config=config)
+    return lookup_cache.lookup(('phone', normalize_phone(phone)), loader, lookup_tags)
+
+
+def lookup_by_surname(surname, config=load_config()):
+    loader = partial(execute_wrapper, SURNAME_LOOKUP_QUERY, surname, prepare=True, config=config)
+    return lookup_cache.lookup(('surname', surname), loader, lookup_tags)
+
+
+def invalidate_lookups(keys=(), tags=(), everything=False):
+    invalidate(keys=keys, tags=tags, everything=everything)
+    if lookup_cache.notify:
+        try:
+            execute_wrapper(partial(publish_invalidation, keys=keys, tags=tags, everything=everything))
+        except Exception as e:
+            raise InvalidationError(f'Could not publish cache invalidation: {e}') from e
+
+
+def insert_users(users, batch_size=INSERT_USERS_BATCH_SIZE, config=load_config()):
+    """ Insert (first_name, second_name, username, phone) tuples set-based, one statement per batch """
+    users = iter(users)
+    inserted = 0
+    with get_pool(config).connection() as conn:
+        with conn.cursor() as cur:
+            while batch := list(islice(users, batch_size)):
+                timed_execute(cur, INSERT_USERS_QUERY, config=config, run=partial(
+                    psycopg2.extras.execute_values, cur, INSERT_USERS_QUERY, batch, page_size=len(batch)
+                ))
+                inserted += cur.rowcount
+    return inserted
+
+
+def run_in_batches(query, items, batch_size=BULK_BATCH_SIZE, template=None, config=load_config()):
+    """ Run query once per batch of items in one transaction and return the total affected row count.
+        Without a template the batch is bound as an array to a single %s; with one it expands VALUES %s """
+    items = iter(items)
+    affected = 0
+    with get_pool(config).connection() as conn:
+        with conn.cursor() as cur:
+            while batch := list(islice(items, batch_size)):
+                if template:
+                    timed_execute(cur, query, config=config, run=partial(
+                        psycopg2.extras.execute_values, cur, query, batch, template=template, page_size=len(batch)
+                    ))
+                else:
+                    timed_execute(cur, query, (batch,), config)
+                affected += cur.rowcount
+    return affected
+
+
+def invalidate_bulk(tag, ids):
+    if len(ids) > BULK_INVALIDATION_TAGS:
+        invalidate_lookups(everything=True)
+    else:
+        invalidate_lookups(tags=[(tag, id_) for id_ in ids])
+
+
+def delete_persons(person_ids, batch_size=BULK_BATCH_SIZE, config=load_config()):
+    person_ids = [int(person_id) for person_id in person_ids]
+    deleted = run_in_batches(BULK_QUERIES['delete_persons'], person_ids, batch_size, config=config)
+    invalidate_bulk('person', person_ids)
+    return deleted
+
+
+def delete_phones(phone_ids, batch_size=BULK_BATCH_SIZE, config=load_config()):
+    phone_ids = [int(phone_id) for phone_id in phone_ids]
+    deleted = run_in_batches(BULK_QUERIES['delete_phones'], phone_ids, batch_size, config=config)
+    invalidate_bulk('phone_id', phone_ids)
+    return deleted
+
+
+def delete_persons_by_phone(phones, batch_size=BULK_BATCH_SIZE, config=load_config()):
+    normalized = [phone for phone in map(normalize_phone, phones) if phone]
+    deleted = run_in_batches(BULK_QUERIES['delete_persons_by_phone'], normalized, batch_size, config=config)
+    invalidate_lookups(everything=True)
+    return deleted
+
+
+def delete_persons_by_first_name(first_names, batch_size=BULK_BATCH_SIZE, config=load_config()):
+    deleted = run_in_batches(BULK_QUERIES['delete_persons_by_first_name'], first_names, batch_size, config=config)
+    invalidate_lookups(everything=True)
+    return deleted
+
+
+def update_persons(rows, batch_size=BULK_BATCH_SIZE, config=load_config()):
+    """ rows are (person_id, first_name, second_name, username); None keeps the current value """
+    updated = run_in_batches(
+        BULK_QUERIES['update_persons'], rows, batch_size,
+        template='(%s::integer, %s::varchar, %s::varchar, %s::varchar)', config=config
+    )
+    invalidate_lookups(everything=True)
+    return updated
+
+
+def update_phones(rows, batch_size=BULK_BATCH_SIZE, config=load_config()):
+    """ rows are (phone_id, phone, person_id); None keeps the current value """
+    updated = run_in_batches(
+        BULK_QUERIES['update_phones'], rows, batch_size,
+        template='(%s::integer, %s::varchar, %s::integer)', config=config
+    )
+    invalidate_lookups(everything=True)
+    return updated
+
+
+def copy_csv(csv_path, table_type='person', config=load_config()):
+    table_name = 'persons' if table_type == 'person' else 'phones'
+
+    def copy_from_csv(cur):
+        with open(csv_path, 'r') as f:
+            next(f)  # Skip header
+            columns = (
+                'first_name,second_name,username'
+                if table_type == 'person'
+                else 'phone,person_id'
+            )
+            cur.copy_from(f, table_name, sep=',', columns=columns.split(','))
+
+    execute_wrapper(copy_from_csv, config=config)
+
+
+class PostgresBackend(StorageBackend):
+    """ The PostgreSQL data layer above, keeping the lookup cache in step with every write """
+
+    def __init__(self, config=load_config()):
+        self.config = config
+
+    def init(self):
+        database_init(self.config)
+
+    def reset(self):
+        execute_wrapper('TRUNCATE persons, phones RESTART IDENTITY CASCADE', config=self.config)
+        invalidate_lookups(everything=True)
+
+    def insert_person(self, first_name, second_name, username):
+        query = """
+            INSERT INTO persons (first_name, second_name, username)
+            VALUES (%s, %s, %s) RETURNING id
+        """
+        rows = execute_wrapper(query, first_name, second_name, username, prepare=True, config=self.config)
+        invalidate_lookups(keys=[('surname', second_name)])
+        return rows[0][0]
+
+    def insert_phone(self, phone, person_id):
+        query = """
+            INSERT INTO phones (phone, person_id)
+            VALUES (%s, %s) RETURNING phone_id
+        """
+        rows = execute_wrapper(query, phone, person_id, prepare=True, config=self.config)
+        invalidate_lookups(keys=[('phone', normalize_phone(phone))])
+        return rows[0][0]
+
+    def insert_users(self, users):
+        users = list(users)
+        inserted = insert_users(users, config=self.config)
+        # New persons can only show up in lookups of their own surname and phone
+        invalidate_lookups(keys={
+            key for _, second_name, _, phone in users
+            for key in (('surname', second_name), ('phone', normalize_phone(phone)))
+        })
+        return inserted
+
+    def copy_csv(self, csv_path, table_type='person'):
+        copy_csv(csv_path, table_type, config=self.config)
+        invalidate_lookups(everything=True)
+
+    def import_csv(self, csv_path, rejects_path=None):
+        report = import_csv(csv_path, rejects_path=rejects_path, config=self.config)
+        invalidate_lookups(everything=True)
+        return report
+
+    def update_person(self, person_id, first_name=None, second_name=None, username=None):
+        values = {'first_name': first_name, 'second_name': second_name, 'username': username}
+        columns = [column for column, value in values.items() if value]
+        if not columns:
+            return 0
+        query = f"UPDATE persons SET {', '.join(f'{column} = %s' for column in columns)} WHERE id = %s RETURNING id"
+        rows = execute_wrapper(query, *[values[column] for column in columns], person_id, prepare=True, config=self.config)
+        invalidate_lookups(keys=[('surname', second_name)], tags=[('person', int(person_id))])
+        return len(rows)
+
+    def update_phone(self, phone_id, phone, person_id=None):
+        updates = ['phone = %s']
+        values = [phone]
+        if person_id:
+            updates.append('person_id = %s')
+            values.append(person_id)
+        query = f"UPDATE phones SET {', '.join(updates)} WHERE phone_id = %s RETURNING phone_id"
+        rows = execute_wrapper(query, *values, phone_id, prepare=True, config=self.config)
+        invalidate_lookups(keys=[('phone', normalize_phone(phone))], tags=[('phone_id', int(phone_id))])
+        return len(rows)
+
+    def delete_person(self, person_id):
+        query = 'DELETE FROM persons WHERE id = %s RETURNING id'
+        rows = execute_wrapper(query, person_id, prepare=True, config=self.config)
+        invalidate_lookups(tags=[('person', int(person_id))])
+        return len(rows)
+
+    def delete_phone(self, phone_id):
+        query = 'DELETE FROM phones WHERE phone_id = %s RETURNING phone_id'
+        rows = execute_wrapper(query, phone_id, prepare=True, config=self.config)
+        invalidate_lookups(tags=[('phone_id', int(phone_id))])
+        return len(rows)
+
+    @staticmethod
+    def select_args(mode, value):
+        if mode not in SELECT_MODES:
+            raise ValueError(f'Unknown select mode {mode!r}')
+        if mode == 'PaN':
+            return (f'%{value}%',)
+        return () if mode in ('ALL', 'PwP') else (value,)
+
+    def ensure_fresh(self, mode):
+        if mode == 'PwP':
+            read_model.ensure_fresh(config=self.config)
+
+    def select(self, mode, value=None):
+        self.ensure_fresh(mode)
+        if mode == 'PhN':
+            return lookup_by_phone(value, config=self.config)
+        if mode == 'SurN':
+            return lookup_by_surname(value, config=self.config)
+        return execute_wrapper(SELECT_QUERIES[mode], *self.select_args(mode, value), prepare=True, config=self.config)
+
+    def paginate(self, mode, limit, value=None, offset=None, after=None):
+        args = self.select_args(mode, value)
+        self.ensure_fresh(mode)
+        if offset is not None:
+            query = SELECT_QUERIES[mode] + ' ' + RECORD_ORDER[mode]
+            return paginate_wrapper(query, limit, offset, *args, config=self.config)
+        return keyset_paginate_wrapper(
+            KEYSET_QUERIES[mode], mode, limit, *args,
+            last_key=None if after is None else tuple(after), config=self.config
+        )
+
+    def stream(self, mode, value=None, itersize=None, ordered=False):
+        query = SELECT_QUERIES[mode] + (' ' + RECORD_ORDER[mode] if ordered else '')
+        args = self.select_args(mode, value)
+        self.ensure_fresh(mode)
+        return stream_wrapper(query, *args, itersize=itersize or STREAM_ITERSIZE, config=self.config)
+
+    def records(self, mode, value=None, itersize=None):
+        if mode in ('PhN', 'SurN'):
+            # Point lookups are small and served from the lookup cache
+            return to_records(mode, self.select(mode, value))
+        return super().records(mode, value, itersize)
+
+    def call_procedure(self, name, args):
+        if name == 'IM':
+            return self.insert_users(args)
+        execute_wrapper(procedure_queries[name], *args, config=self.config)
+        invalidate_lookups(everything=True)
+
+
+_backend = None
+
+
+def get_backend(config=load_config()):
+    """ The storage backend named in the [storage] section, created once per process """
+    global _backend
+    if _backend is None:
+        storage = load_storage_config()
+        if storage['backend'] == 'sqlite':
+            _backend = SqliteBackend(storage['sqlite_path'])
+        else:
+            _backend = PostgresBackend(config)
+    return _backend
 
 
 def call_procedure():
@@ -158,8 +497,7 @@ def call_procedure():
             Insert several users -> IM
             Exit -> E
     """)
-    query = procedure_queries.get(procedure_name, None)
-    if not query: return
+    if procedure_name not in procedure_queries: return
     args  = []
     input_arg = "_"
     while input_arg != "E" and procedure_name != "IM":
@@ -174,8 +512,8 @@ def call_procedure():
             user_data = tuple([first_name, second_name, username, phone])
             args.append(user_data)
             input_arg = input("E to exit, Enter to add new user")
-        execute_wrapper(query, args)
-    elif args: execute_wrapper(query, *args)
+        print(f'Inserted {get_backend().insert_users(args)} users')
+    elif args: get_backend().call_procedure(procedure_name, args)
 
 
 def insert_data(table_type='person'):
@@ -183,6 +521,8 @@ def insert_data(table_type='person'):
         """
         Choose the method for inserting:
             Insert by csv  -> C
+            Insert persons with phones by combined csv  -> B
+            Insert persons with phones in parallel (file or directory)  -> P
             Insert by request  -> R
             Exit -> E
         """
@@ -191,40 +531,37 @@ def insert_data(table_type='person'):
         case "C":
             csv_filename = input('Specify the filename ')
             csv_path = os.path.join(CSV_BASE_PATH, csv_filename)
-            table_name = 'persons' if table_type == 'person' else 'phones'
-
-            def copy_from_csv(cur):
-                with open(csv_path, 'r') as f:
-                    next(f)  # Skip header
-                    columns = (
-                        'first_name,second_name,username'
-                        if table_type == 'person'
-                        else 'phone,person_id'
-                    )
-                    cur.copy_from(f, table_name, sep=',', columns=columns.split(','))
-            
-            execute_wrapper(copy_from_csv)
+            get_backend().copy_csv(csv_path, table_type)
+
+        case "B":
+            csv_filename = input('Specify the filename ')
+            report = get_backend().import_csv(os.path.join(CSV_BASE_PATH, csv_filename))
+            print(report)
+            if report.rows_rejected:
+                print(f'Rejected rows written to {report.rejects_path}')
+
+        case "P":
+            if not isinstance(get_backend(), PostgresBackend):
+                print('Parallel import needs the PostgreSQL backend')
+                return
+            csv_name = input('Specify the filename or directory ')
+            workers = input('Enter number of workers (Enter for CPU count): ')
+            report = import_parallel(os.path.join(CSV_BASE_PATH, csv_name), int(workers or 0) or None)
+            print(report)
+            if report.rows_rejected:
+                print(f'Rejected rows written to {report.rejects_path}')
+            invalidate_lookups(everything=True)
 
         case "R":
             if table_type == 'person':
                 first_name = input('Enter first name: ')
                 second_name = input('Enter second name: ')
                 username = input('Enter username: ')
-                
-                query = """
-                    INSERT INTO persons (first_name, second_name, username)
-                    VALUES (%s, %s, %s)
-                """
-                execute_wrapper(query, first_name, second_name, username)
+                get_backend().insert_person(first_name, second_name, username)
             else:
                 phone = input('Enter phone number: ')
                 person_id = input('Enter person ID: ')
-                
-                query = """
-                    INSERT INTO phones (phone, person_id)
-                    VALUES (%s, %s)
-                """
-                execute_wrapper(query, phone, person_id)
+                get_backend().insert_phone(phone, person_id)
         case "E":
             return
 
@@ -235,51 +572,83 @@ def update_data(table_type='person'):
         first_name = input('Enter new first name (Enter to skip): ')
         second_name = input('Enter new second name (Enter to skip): ')
         username = input('Enter new username (Enter to skip): ')
-
-        updates = []
-        values = []
-        if first_name:
-            updates.append('first_name = %s')
-            values.append(first_name)
-        if second_name:
-            updates.append('second_name = %s')
-            values.append(second_name)
-        if username:
-            updates.append('username = %s')
-            values.append(username)
-
-        if updates:
-            values.append(person_id)
-            query = f"UPDATE persons SET {', '.join(updates)} WHERE id = %s"
-            execute_wrapper(query, *values)
+        get_backend().update_person(person_id, first_name, second_name, username)
     else:
         phone_id = input('Enter phone ID to update: ')
         phone = input('Enter new phone number ')
         person_id = input('Enter new person ID (Enter to skip): ')
-
-        updates = ['phone = %s']
-        values = [phone]
-        if person_id:
-            updates.append('person_id = %s')
-            values.append(person_id)
-
-        values.append(phone_id)
-        query = f"UPDATE phones SET {', '.join(updates)} WHERE phone_id = %s"
-        execute_wrapper(query, *values)
+        get_backend().update_phone(phone_id, phone, person_id)
 
 
 def delete_data(table_type='person'):
     if table_type == 'person':
         person_id = input('Enter person ID to delete: ')
-        query = 'DELETE FROM persons WHERE id = %s'
-        execute_wrapper(query, person_id)
+        get_backend().delete_person(person_id)
     else:
         phone_id = input('Enter phone ID to delete: ')
-        query = 'DELETE FROM phones WHERE phone_id = %s'
-        execute_wrapper(query, phone_id)
+        get_backend().delete_phone(phone_id)
 
+def search_data():
+    search_option = input(
+        """
+        Choose the method for searching:
+            Search by part of first or second name  -> S
+            Autocomplete by name prefix  -> A
+            Exit -> E
+        """
+    )
+    if search_option not in ('S', 'A'):
+        return
+    term = input('Enter name or part of name: ')
+    limit = input('Enter number of results (Enter for default): ')
+    results = search_persons(term, int(limit or SEARCH_LIMIT), prefix=search_option == 'A')
+    for person_id, first_name, second_name, username, rank, phones in results:
+        print(person_id, first_name, second_name, username, f'{rank:.2f}', ', '.join(phones))
+
+
+def read_model_status():
+    print(read_model.report())
+    answer = input('Apply pending changes now? (y/N/full): ').lower()
+    if answer in ('y', 'full'):
+        print(f"Rebuilt {read_model.refresh(full=answer == 'full')} persons")
+
+
+def show_metrics():
+    fmt = input('Enter format (json, prometheus): ')
+    if fmt == 'prometheus':
+        print(query_metrics.to_prometheus())
+    else:
+        print(query_metrics.to_json(indent=2))
 
-def select_data(paginated=False):
+
+def export_data():
+    select_option = input(
+        """
+        Choose what to export:
+            Export all  -> ALL
+            Export by part of name  -> PaN
+            Export by phone number  -> PhN
+            Export by surname  -> SurN
+            Export persons with their phones  -> PwP
+            Exit -> E
+        """
+    )
+    if select_option not in SELECT_QUERIES:
+        return
+    args = []
+    if select_option == 'PaN':
+        args.append(f"%{input('Enter part of name: ')}%")
+    elif select_option not in ('ALL', 'PwP'):
+        args.append(input('Enter value to filter by: '))
+    if select_option == 'PwP':
+        read_model.ensure_fresh()
+    fmt = input(f"Enter format ({', '.join(EXPORT_FORMATS)}): ") or 'csv'
+    compress = input('Compress with gzip? (y/N): ').lower() == 'y'
+    path = input('Enter output path: ')
+    print(export_query(SELECT_QUERIES[select_option], args, path, fmt, compress))
+
+
+def select_data(paginated=False, streaming=False):
     select_option = input(
         """
         Choose the method for selecting:
@@ -287,39 +656,39 @@ def select_data(paginated=False):
             Select by part of name  -> PaN
             Select by phone number  -> PhN
             Select by surname  -> SurN
+            Select persons with their phones  -> PwP
             Exit -> E
         """
     )
-    args = []
+    value = None
     match select_option:
-        case "ALL":
-            query = "SELECT * FROM persons JOIN phones on persons.id = phones.person_id"
         case "PaN":
-            part_of_name = input('Enter part of name: ')
-            query = "SELECT * FROM persons WHERE first_name LIKE %s"
-            args.append(f'%{part_of_name}%')
+            value = input('Enter part of name: ')
         case "PhN":
-            phone_number = input('Enter phone number: ')
-            query = """
-                SELECT * FROM persons 
-                JOIN phones on persons.id = phones.person_id 
-                WHERE phone = %s
-            """
-            args.append(phone_number)
+            value = input('Enter phone number: ')
         case "SurN":
-            surname = input('Enter surname: ')
-            query = "SELECT * FROM persons WHERE second_name = %s"
-            args.append(surname)
-        case "E":
+            value = input('Enter surname: ')
+        case "ALL" | "PwP":
+            pass
+        case _:
             return
 
-    if not paginated:
-        data = execute_wrapper(query, *args)
-        print(data)
+    backend = get_backend()
+    if streaming:
+        itersize = input('Enter itersize (Enter for default): ')
+        for row in backend.stream(select_option, value, itersize=int(itersize or STREAM_ITERSIZE)):
+            print(row)
+    elif not paginated:
+        for record in backend.records(select_option, value):
+            print(record)
     else:
-        offset = input('Enter offset: ')
-        limit = input('Enter limit: ')
-        data = paginate_wrapper(query, limit, offset, *args)
+        if paginated == 'keyset':
+            limit = int(input('Enter limit: '))
+            data = backend.paginate(select_option, limit, value)
+        else:
+            offset = int(input('Enter offset: '))
+            limit = int(input('Enter limit: '))
+            data = backend.paginate(select_option, limit, value, offset=offset)
         for page in data:
             print(page)
             page_call = input('Press anything to continue, or E to exit: ')
@@ -329,7 +698,9 @@ def select_data(paginated=False):
 
 if __name__ == "__main__":
     config = load_config()
-    database_init(config)
+    get_backend(config).init()
+    if isinstance(get_backend(), PostgresBackend) and lookup_cache.notify:
+        start_listener(config)
 
     handlers = {
         'I': partial(insert_data, 'person'),
@@ -340,7 +711,15 @@ if __name__ == "__main__":
         'DP': partial(delete_data, 'phone'),
         'S': select_data,
         "SP": partial(select_data, True),
+        "SK": partial(select_data, 'keyset'),
+        "SS": partial(select_data, streaming=True),
         "uP": call_procedure,
+        'F': search_data,
+        'PS': lambda: print(pool_stats()),
+        'CS': lambda: print(lookup_cache.stats.snapshot()),
+        'X': export_data,
+        'M': show_metrics,
+        'RM': read_model_status,
         'E': lambda: exit(0)
     }
 
@@ -357,7 +736,15 @@ if __name__ == "__main__":
                     Delete Phone  -> DP
                     Select Data  -> S
                     Select Data Paginated -> SP
+                    Select Data Keyset Paginated -> SK
+                    Select Data Streamed -> SS
                     Use Procedures -> uP
+                    Search Persons -> F
+                    Pool Statistics -> PS
+                    Cache Statistics -> CS
+                    Export Data -> X
+                    Query Metrics -> M
+                    Read Model Status -> RM
                     Exit -> E
                 """
             ))
@@ -0,0 +1,214 @@
+import psycopg2
+import psycopg2.errors
+from search import SEARCH_INDEXES
+from bulk_import import STAGING_DDL
+from phone_normalization import NORMALIZATION_DDL, PHONE_MATCHING_DDL
+from read_model import READ_MODEL_DDL
+
+# Arbitrary constant shared by every worker so only one of them applies migrations at a time
+MIGRATION_LOCK_KEY = 7710501
+
+SCHEMA_VERSION_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# Migrations are applied in order and never edited once released; add a new entry instead.
+# Version 1 must stay idempotent: databases bootstrapped before versioning already have its objects.
+MIGRATIONS = [
+    (1, 'persons, phones and procedures', [
+        """
+        CREATE TABLE IF NOT EXISTS persons (
+            id SERIAL PRIMARY KEY,
+            first_name VARCHAR(35) NOT NULL,
+            second_name VARCHAR(35) NOT NULL,
+            username VARCHAR(35) NOT NULL UNIQUE
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS phones (
+            phone_id SERIAL PRIMARY KEY,
+            phone VARCHAR(20) NOT NULL UNIQUE,
+            person_id INTEGER,
+            FOREIGN KEY (person_id)
+            REFERENCES persons (id)
+            ON UPDATE CASCADE ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE OR REPLACE PROCEDURE add_update_user(
+            fname VARCHAR(35),
+            sname VARCHAR(35),
+            username VARCHAR(35),
+            phone VARCHAR(20)
+        )
+        LANGUAGE plpgsql
+        AS $$
+        DECLARE
+            personId INTEGER;
+        BEGIN
+            SELECT INTO personId FROM persons WHERE first_name = fname AND second_name = sname;
+            IF personId IS NULL
+                THEN
+                    INSERT INTO persons (first_name, second_name, username) VALUES (fname, sname, username) RETURNING id INTO personId;
+                    INSERT INTO phones (phone, person_id) VALUES (phone, personId);
+                ELSE
+                    UPDATE phones SET phone = phone WHERE person_id = personId;
+            END IF;
+        END;
+        $$;
+        """,
+        """
+        CREATE OR REPLACE PROCEDURE delete_by_phone_or_name(
+            method VARCHAR(2),
+            fname VARCHAR(35),
+            phone VARCHAR(20)
+        )
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            IF (method = 'ph' AND phone IS NOT NULL) THEN
+                    DELETE FROM persons WHERE id = (SELECT person_id from phones where phone = phone);
+            ELSIF (method = 'fn' AND fname IS NOT NULL) THEN
+                    DELETE FROM persons WHERE first_name = fname;
+            ELSE
+                RAISE NOTICE 'INVALID INPUT';
+            END IF;
+        END;
+        $$
+        """,
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'person_data') THEN
+                CREATE TYPE person_data AS (
+                    fname VARCHAR(35),
+                    sname VARCHAR(35),
+                    username VARCHAR(35),
+                    phone VARCHAR(20)
+                );
+            END IF;
+        END;
+        $$
+        """,
+        """
+        CREATE OR REPLACE PROCEDURE insert_many_users(
+            persons_data person_data[]
+        )
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            WITH data AS (
+                SELECT * FROM unnest(persons_data)
+            ), inserted AS (
+                INSERT INTO persons (first_name, second_name, username)
+                SELECT fname, sname, username FROM data
+                RETURNING id, username
+            )
+            INSERT INTO phones (phone, person_id)
+            SELECT data.phone, inserted.id
+            FROM data JOIN inserted ON inserted.username = data.username;
+        END;
+        $$
+        """,
+    ]),
+    (2, 'name search indexes', SEARCH_INDEXES),
+    (3, 'bulk import staging table', [STAGING_DDL]),
+    (4, 'normalized phone numbers', NORMALIZATION_DDL),
+    (5, 'set-based, index-backed delete_by_phone_or_name', [
+        "CREATE INDEX IF NOT EXISTS persons_first_name_idx ON persons (first_name);",
+        # The phone parameter used to shadow phones.phone, so "phone = phone" matched every row
+        """
+        CREATE OR REPLACE PROCEDURE delete_by_phone_or_name(
+            method VARCHAR(2),
+            fname VARCHAR(35),
+            phone VARCHAR(20)
+        )
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            IF (method = 'ph' AND phone IS NOT NULL) THEN
+                    DELETE FROM persons WHERE id IN (
+                        SELECT person_id FROM phones
+                        WHERE phones.phone_normalized = normalize_phone(delete_by_phone_or_name.phone)
+                    );
+            ELSIF (method = 'fn' AND fname IS NOT NULL) THEN
+                    DELETE FROM persons WHERE first_name = fname;
+            ELSE
+                RAISE NOTICE 'INVALID INPUT';
+            END IF;
+        END;
+        $$
+        """,
+    ]),
+    (6, 'person_phones read model', READ_MODEL_DDL),
+    # Migration 4 leaves existing rows NULL until backfill() reaches them; match those by phone meanwhile
+    (7, 'phone matching for rows not yet normalized', PHONE_MATCHING_DDL + [
+        """
+        CREATE OR REPLACE PROCEDURE delete_by_phone_or_name(
+            method VARCHAR(2),
+            fname VARCHAR(35),
+            phone VARCHAR(20)
+        )
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            IF (method = 'ph' AND phone IS NOT NULL) THEN
+                    DELETE FROM persons WHERE id IN (
+                        SELECT person_id FROM phones_matching(delete_by_phone_or_name.phone)
+                    );
+            ELSIF (method = 'fn' AND fname IS NOT NULL) THEN
+                    DELETE FROM persons WHERE first_name = fname;
+            ELSE
+                RAISE NOTICE 'INVALID INPUT';
+            END IF;
+        END;
+        $$
+        """,
+    ]),
+    # Keyset pages of the joined modes walk persons by id and each person's phones by phone_id
+    (8, 'phones index for keyset pages by person', [
+        "CREATE INDEX IF NOT EXISTS phones_person_id_phone_id_idx ON phones (person_id, phone_id);",
+        "DROP INDEX IF EXISTS phones_person_id_idx;",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cur):
+    cur.execute('SELECT max(version) FROM schema_version')
+    return cur.fetchone()[0] or 0
+
+
+def migrate(conn):
+    """ Bring the schema up to LATEST_VERSION; a single query when it already is """
+    with conn.cursor() as cur:
+        try:
+            version = current_version(cur)
+        except psycopg2.errors.UndefinedTable:
+            conn.rollback()
+            version = 0
+        if version >= LATEST_VERSION:
+            conn.commit()
+            return version
+
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_KEY,))
+        cur.execute(SCHEMA_VERSION_DDL)
+        version = current_version(cur)
+        for migration_version, description, commands in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            for command in commands:
+                cur.execute(command)
+            cur.execute(
+                'INSERT INTO schema_version (version, description) VALUES (%s, %s)',
+                (migration_version, description)
+            )
+            print(f'Applied migration {migration_version}: {description}')
+            version = migration_version
+    conn.commit()
+    return version
@@ -0,0 +1,229 @@
+""" Parallel import of large combined first_name,second_name,username,phone CSVs.
+
+Files are split into byte ranges that end on a line break, and the ranges are validated and
+COPYed concurrently over separate connections into one UNLOGGED staging table per run. The
+staged rows are then merged into persons/phones in a single final transaction, so a failed run
+leaves the phonebook untouched. Ranges are cut at raw line breaks, so quoted fields must not
+contain newlines.
+
+Usage: python parallel_import.py persons_phones.csv|csv_dir [--workers 8] [--chunk-mb 32] [--processes]
+"""
+import argparse
+import csv
+import io
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+from config import load_config
+from pool import get_pool
+from instrumentation import timed_execute
+from bulk_import import (
+    ImportReport, IMPORT_COLUMNS, STAGING_TABLE, STAGING_COPY, validate_row, copy_rows, merge_staging
+)
+
+CHUNK_BYTES = 32 * 1024 * 1024
+# Staged line_no values are (chunk_index << LINE_BITS) | line within the chunk, mapped back to file lines at the end
+LINE_BITS = 32
+
+
+@dataclass
+class Chunk:
+    index: int
+    path: str
+    start: int
+    end: int
+
+
+@dataclass
+class ChunkResult:
+    index: int
+    worker: str
+    lines: int
+    rows_staged: int
+    bytes_read: int
+    elapsed: float
+    rejected: list
+
+
+@dataclass
+class WorkerStats:
+    chunks: int = 0
+    rows: int = 0
+    bytes_read: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+@dataclass
+class ParallelImportReport(ImportReport):
+    workers: dict = field(default_factory=dict)
+    copy_elapsed: float = 0.0
+    merge_elapsed: float = 0.0
+
+    def __str__(self):
+        lines = [
+            super().__str__(),
+            f'COPY phase {self.copy_elapsed:.2f}s, merge phase {self.merge_elapsed:.2f}s',
+        ]
+        for worker, stats in sorted(self.workers.items()):
+            lines.append(
+                f'  {worker}: {stats.chunks} chunks, {stats.rows} rows, {stats.bytes_read / 2**20:.1f} MiB '
+                f'in {stats.elapsed:.2f}s ({stats.rows_per_sec:.0f} rows/sec)'
+            )
+        return '\n'.join(lines)
+
+
+def csv_paths(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.csv'))
+    return [path]
+
+
+def byte_ranges(path, chunk_bytes=CHUNK_BYTES):
+    """ Yield (start, end) offsets covering the file, each range ending just after a line break """
+    size = os.path.getsize(path)
+    start = 0
+    with open(path, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def split_files(paths, chunk_bytes=CHUNK_BYTES):
+    index = 0
+    for path in paths:
+        for start, end in byte_ranges(path, chunk_bytes):
+            yield Chunk(index, path, start, end)
+            index += 1
+
+
+def stage_chunk(chunk, staging, config):
+    """ Validate one byte range and COPY its valid rows into the staging table, on a connection of its own """
+    start = time.perf_counter()
+    with open(chunk.path, 'rb') as f:
+        f.seek(chunk.start)
+        data = f.read(chunk.end - chunk.start)
+
+    reader = csv.reader(io.StringIO(data.decode('utf-8')))
+    if chunk.start == 0:
+        next(reader, None)  # Skip header
+    staged, rejected = [], []
+    for row in reader:
+        line = reader.line_num
+        row = [value.strip() for value in row]
+        reason = validate_row(row)
+        if reason:
+            rejected.append((line, *row, reason))
+        else:
+            staged.append(((chunk.index << LINE_BITS) | line, *row))
+
+    if staged:
+        with get_pool(config).connection() as conn:
+            with conn.cursor() as cur:
+                copy_rows(cur, STAGING_COPY.format(staging=staging), staged)
+
+    lines = data.count(b'\n') + (0 if data.endswith(b'\n') else 1)
+    worker = f'{os.getpid()}/{threading.current_thread().name}'
+    return ChunkResult(
+        chunk.index, worker, lines, len(staged), len(data), time.perf_counter() - start, rejected
+    )
+
+
+def import_parallel(path, workers=None, chunk_bytes=CHUNK_BYTES, processes=False, rejects_path=None,
+                    config=load_config()):
+    """ Import a combined CSV, or every *.csv in a directory, over `workers` concurrent connections.
+
+    Threads share this process's connection pool, so their number is capped at its maxconn.
+    processes=True runs workers in spawned processes, each with its own pool, so CSV parsing
+    also runs in parallel.
+    """
+    pool = get_pool(config)
+    workers = workers or os.cpu_count()
+    if not processes:
+        workers = min(workers, pool.maxconn)
+    paths = csv_paths(path)
+    report = ParallelImportReport(
+        rejects_path=rejects_path or os.path.join(os.path.dirname(paths[0]) if paths else '.', 'import.rejected.csv')
+    )
+    chunks = list(split_files(paths, chunk_bytes))
+    report.chunks = len(chunks)
+    staging = f'{STAGING_TABLE}_{uuid.uuid4().hex[:12]}'
+    start = time.perf_counter()
+
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            timed_execute(cur, f'CREATE UNLOGGED TABLE {staging} (LIKE {STAGING_TABLE})', config=config)
+
+    try:
+        if processes:
+            executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            executor = ThreadPoolExecutor(workers, thread_name_prefix='import')
+        with executor:
+            results = list(executor.map(stage_chunk, chunks, [staging] * len(chunks), [config] * len(chunks)))
+        report.copy_elapsed = time.perf_counter() - start
+
+        merge_start = time.perf_counter()
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                timed_execute(cur, f'ANALYZE {staging}', config=config)
+                conflicts = merge_staging(cur, staging)
+        report.merge_elapsed = time.perf_counter() - merge_start
+    finally:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                timed_execute(cur, f'DROP TABLE IF EXISTS {staging}', config=config)
+
+    # Line numbers of each chunk continue from the previous chunk of the same file
+    first_line = {}
+    for chunk, result in zip(chunks, results):
+        first_line[chunk.index] = 1 if chunk.start == 0 else previous_end
+        previous_end = first_line[chunk.index] + result.lines
+
+    rejected = []
+    for chunk, result in zip(chunks, results):
+        report.rows_read += result.rows_staged + len(result.rejected)
+        rejected += [(chunk.path, first_line[chunk.index] + line - 1, *row) for line, *row in result.rejected]
+        stats = report.workers.setdefault(result.worker, WorkerStats())
+        stats.chunks += 1
+        stats.rows += result.rows_staged + len(result.rejected)
+        stats.bytes_read += result.bytes_read
+        stats.elapsed += result.elapsed
+    for line_no, *row in conflicts:
+        chunk = chunks[line_no >> LINE_BITS]
+        line = line_no & ((1 << LINE_BITS) - 1)
+        rejected.append((chunk.path, first_line[chunk.index] + line - 1, *row))
+
+    with open(report.rejects_path, 'w', newline='') as rejects_file:
+        rejects = csv.writer(rejects_file)
+        rejects.writerow(('file', 'line_no', *IMPORT_COLUMNS, 'reason'))
+        rejects.writerows(sorted(rejected))
+    report.rows_rejected = len(rejected)
+    report.rows_imported = report.rows_read - report.rows_rejected
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import combined phonebook CSVs over several connections')
+    parser.add_argument('path', help='CSV file or directory of CSV files')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-mb', type=float, default=CHUNK_BYTES / 2**20)
+    parser.add_argument('--processes', action='store_true', help='use worker processes instead of threads')
+    parser.add_argument('--rejects')
+    cli_args = parser.parse_args()
+
+    print(import_parallel(
+        cli_args.path, cli_args.workers, int(cli_args.chunk_mb * 2**20), cli_args.processes, cli_args.rejects
+    ))
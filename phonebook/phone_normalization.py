@@ -0,0 +1,162 @@
+""" Canonical digits-only phone numbers.
+
+"+7 (701) 123-45-67", "8 701 123 45 67" and "87011234567" all normalize to "77011234567":
+non-digits are dropped and the domestic 11-digit "8" trunk prefix is replaced by the "7" country code.
+The phones_normalize_phone trigger fills phones.phone_normalized on every insert path (INSERT, COPY,
+procedures). Rows that predate it are filled by backfill() in short transactions, which database_init
+runs after migrating; until it reaches a row, phones_matching() finds it by normalizing on the fly.
+
+Usage: python phone_normalization.py [--batch-size 5000]
+"""
+import argparse
+import re
+import time
+
+import psycopg2
+import psycopg2.errors
+from config import load_config
+from pool import get_pool
+from instrumentation import timed_execute
+
+BACKFILL_BATCH_SIZE = 5000
+BACKFILL_RETRIES = 3
+
+NORMALIZATION_DDL = [
+    "ALTER TABLE phones ADD COLUMN IF NOT EXISTS phone_normalized VARCHAR(20);",
+    r"""
+    CREATE OR REPLACE FUNCTION normalize_phone(phone TEXT) RETURNS VARCHAR(20)
+    LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE
+    AS $$
+        SELECT NULLIF(regexp_replace(regexp_replace(phone, '\D', '', 'g'), '^8(\d{10})$', '7\1'), '')
+    $$;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION phones_normalize_phone() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        NEW.phone_normalized := normalize_phone(NEW.phone);
+        RETURN NEW;
+    END;
+    $$;
+    """,
+    "DROP TRIGGER IF EXISTS phones_normalize_phone ON phones;",
+    """
+    CREATE TRIGGER phones_normalize_phone
+    BEFORE INSERT OR UPDATE OF phone ON phones
+    FOR EACH ROW EXECUTE FUNCTION phones_normalize_phone();
+    """,
+    # Pre-existing rows are NULL here, so building the index is cheap; backfill() fills them in afterwards
+    "CREATE UNIQUE INDEX IF NOT EXISTS phones_phone_normalized_key ON phones (phone_normalized);",
+]
+
+BACKFILL_QUERY = """
+    UPDATE phones SET phone_normalized = candidates.normalized
+    FROM (
+        SELECT DISTINCT ON (normalize_phone(phone)) phone_id, normalize_phone(phone) AS normalized
+        FROM phones
+        WHERE phone_id > %s AND phone_id <= %s AND phone_normalized IS NULL
+        ORDER BY normalize_phone(phone), phone_id
+    ) candidates
+    WHERE phones.phone_id = candidates.phone_id
+    AND candidates.normalized IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM phones taken WHERE taken.phone_normalized = candidates.normalized)
+"""
+
+# Lookups and deletes by phone go through phones_matching(), so rows still NULL match as well
+PHONE_MATCHING_DDL = [
+    """
+    CREATE INDEX IF NOT EXISTS phones_unnormalized_idx
+    ON phones (normalize_phone(phone)) WHERE phone_normalized IS NULL;
+    """,
+    # A single-SELECT SQL function is inlined into the calling query, so both branches use an index
+    """
+    CREATE OR REPLACE FUNCTION phones_matching(wanted TEXT) RETURNS SETOF phones
+    LANGUAGE sql STABLE
+    AS $$
+        SELECT * FROM phones
+        WHERE phone_normalized = normalize_phone(wanted)
+        OR (phone_normalized IS NULL AND normalize_phone(phone) = normalize_phone(wanted))
+    $$;
+    """,
+]
+
+# Whether backfill() has anything left to fill: NULL rows whose normalized number is still free
+PENDING_QUERY = """
+    SELECT EXISTS (
+        SELECT 1 FROM phones
+        WHERE phone_normalized IS NULL AND normalize_phone(phone) IS NOT NULL
+        AND NOT EXISTS (SELECT 1 FROM phones taken WHERE taken.phone_normalized = normalize_phone(phones.phone))
+    )
+"""
+
+UNRESOLVED_QUERY = """
+    SELECT phone_id, phone, normalize_phone(phone)
+    FROM phones
+    WHERE phone_normalized IS NULL
+    ORDER BY phone_id
+"""
+
+
+def normalize_phone(phone):
+    """ Python mirror of the normalize_phone SQL function; None when the input has no digits """
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    return digits or None
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE, config=load_config()):
+    """ Fill phone_normalized for old rows in short phone_id-range transactions, so no long lock is held.
+
+    Rows whose normalized number is already taken (format-only duplicates) stay NULL and are returned
+    as (phone_id, phone, normalized) so they can be merged or deleted by hand.
+    """
+    pool = get_pool(config)
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            timed_execute(
+                cur,
+                'SELECT COALESCE(min(phone_id) - 1, 0), COALESCE(max(phone_id), 0) FROM phones '
+                'WHERE phone_normalized IS NULL',
+                config=config
+            )
+            min_id, max_id = cur.fetchone()
+
+    updated = 0
+    start = time.perf_counter()
+    for low in range(min_id, max_id, batch_size):
+        for attempt in range(BACKFILL_RETRIES):
+            try:
+                with pool.connection() as conn:
+                    with conn.cursor() as cur:
+                        timed_execute(cur, BACKFILL_QUERY, (low, low + batch_size), config)
+                        updated += cur.rowcount
+                break
+            except psycopg2.errors.UniqueViolation:
+                # A concurrent insert took the same normalized number; the retry will skip it
+                if attempt == BACKFILL_RETRIES - 1:
+                    raise
+    print(f'Backfilled {updated} phones in {time.perf_counter() - start:.2f}s')
+
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            timed_execute(cur, UNRESOLVED_QUERY, config=config)
+            return cur.fetchall()
+
+
+def backfill_pending(config=load_config()):
+    with get_pool(config).connection() as conn:
+        with conn.cursor() as cur:
+            timed_execute(cur, PENDING_QUERY, config=config)
+            return cur.fetchone()[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backfill phones.phone_normalized')
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE)
+    cli_args = parser.parse_args()
+
+    unresolved = backfill(cli_args.batch_size)
+    for phone_id, phone, normalized in unresolved:
+        print(f'Not normalized: phone_id={phone_id} phone={phone!r} normalized={normalized!r}')
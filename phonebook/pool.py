@@ -0,0 +1,134 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from config import load_config, load_settings, default_filename
+
+POOL_DEFAULTS = {
+    'minconn': 1,
+    'maxconn': 10,
+    'timeout': 30.0,
+}
+
+
+def load_pool_config(filename=default_filename, section='pool'):
+    """ Read pool sizing from the [pool] section, falling back to defaults """
+    return load_settings(POOL_DEFAULTS, section, filename)
+
+
+@dataclass
+class PoolStats:
+    checkouts: int = 0
+    waits: int = 0
+    wait_time: float = 0.0
+    max_wait_time: float = 0.0
+    timeouts: int = 0
+    discarded: int = 0
+    in_use: int = 0
+    max_in_use: int = 0
+
+    def snapshot(self):
+        stats = asdict(self)
+        stats['avg_wait_time'] = self.wait_time / self.waits if self.waits else 0.0
+        return stats
+
+
+class ConnectionPool:
+    """ Blocking wrapper over ThreadedConnectionPool that waits for a free slot and counts checkouts """
+
+    def __init__(self, config, minconn=1, maxconn=10, timeout=30.0):
+        if minconn > maxconn:
+            raise ValueError('minconn ({0}) is greater than maxconn ({1})'.format(minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.stats = PoolStats()
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **config)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+
+    def getconn(self):
+        start = time.perf_counter()
+        waited = not self._slots.acquire(blocking=False)
+        if waited and not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats.waits += 1
+                self.stats.timeouts += 1
+            raise PoolError('No connection available after {0} seconds'.format(self.timeout))
+        wait_time = time.perf_counter() - start
+
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.stats.checkouts += 1
+            if waited:
+                self.stats.waits += 1
+                self.stats.wait_time += wait_time
+                self.stats.max_wait_time = max(self.stats.max_wait_time, wait_time)
+            self.stats.in_use += 1
+            self.stats.max_in_use = max(self.stats.max_in_use, self.stats.in_use)
+        return conn
+
+    def putconn(self, conn, close=False):
+        try:
+            self._pool.putconn(conn, close=close or bool(conn.closed))
+        finally:
+            with self._lock:
+                self.stats.in_use -= 1
+                if close:
+                    self.stats.discarded += 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        broken = False
+        try:
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def closeall(self):
+        if not self._pool.closed:
+            self._pool.closeall()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(config=None, pool_config=None):
+    """ Return the shared pool for the given connection config, creating it on first use """
+    config = config if config is not None else load_config()
+    key = tuple(sorted(config.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(config, **(pool_config or load_pool_config()))
+        return _pools[key]
+
+
+def pool_stats():
+    return {
+        '{0}@{1}/{2}'.format(dict(key).get('user'), dict(key).get('host'), dict(key).get('database')): pool.stats.snapshot()
+        for key, pool in _pools.items()
+    }
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
@@ -0,0 +1,35 @@
+import hashlib
+import re
+import threading
+import weakref
+
+# Statement name -> SQL text, for every statement prepared so far in this process
+registry = {}
+# Connection -> names already PREPAREd on it; entries disappear with the connection
+_prepared = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def statement_name(query):
+    return 'ps_' + hashlib.sha1(query.encode()).hexdigest()[:16]
+
+
+def to_positional(query):
+    """ Rewrite psycopg2 %s placeholders as $1, $2, ... for PREPARE """
+    counter = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda match: f'${next(counter)}', query)
+
+
+def execute_prepared(cur, query, args=()):
+    """ Execute query through a server-side prepared statement, preparing it on first use per connection """
+    name = statement_name(query)
+    with _lock:
+        names = _prepared.setdefault(cur.connection, set())
+        registry.setdefault(name, query)
+    if name not in names:
+        cur.execute(f'PREPARE {name} AS {to_positional(query)}')
+        names.add(name)
+    if args:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+    else:
+        cur.execute(f'EXECUTE {name}')
@@ -0,0 +1,283 @@
+""" person_phones: one row per person with arrays of their phones, maintained incrementally.
+
+Statement-level triggers on persons and phones record the ids of changed persons in
+person_phones_dirty, which costs writes one small insert per affected person. refresh() then
+rebuilds only those persons' rows, in short batches. The read model therefore lags writes by
+at most the time since the oldest dirty row, and report() shows that lag together with the cost
+of recent refreshes. Like the ALL join, it lists only persons that have at least one phone.
+
+Usage: python read_model.py report | refresh [--full] [--batch-size 10000]
+"""
+import argparse
+import time
+
+from config import load_config, load_settings
+from pool import get_pool
+from instrumentation import timed_execute
+
+READ_MODEL_DEFAULTS = {
+    # Readers refresh first when the oldest unapplied change is older than this; negative disables
+    'max_staleness_s': 5.0,
+    'batch_size': 10000,
+}
+
+PERSON_PHONES_SELECT = """
+    SELECT p.id, p.first_name, p.second_name, p.username,
+           array_agg(ph.phone_id ORDER BY ph.phone_id),
+           array_agg(ph.phone ORDER BY ph.phone_id),
+           array_agg(ph.phone_normalized ORDER BY ph.phone_id)
+    FROM persons p
+    JOIN phones ph ON ph.person_id = p.id
+"""
+
+READ_MODEL_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS person_phones (
+        id INTEGER PRIMARY KEY,
+        first_name VARCHAR(35) NOT NULL,
+        second_name VARCHAR(35) NOT NULL,
+        username VARCHAR(35) NOT NULL,
+        phone_ids INTEGER[] NOT NULL,
+        phones VARCHAR(20)[] NOT NULL,
+        phones_normalized VARCHAR(20)[] NOT NULL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS person_phones_phones_normalized_idx ON person_phones USING gin (phones_normalized);",
+    """
+    CREATE TABLE IF NOT EXISTS person_phones_dirty (
+        person_id INTEGER PRIMARY KEY,
+        changed_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS person_phones_refreshes (
+        refreshed_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp(),
+        kind VARCHAR(11) NOT NULL,
+        persons INTEGER NOT NULL,
+        duration_ms DOUBLE PRECISION NOT NULL
+    );
+    """,
+    """
+    CREATE OR REPLACE FUNCTION person_phones_mark_dirty() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'phones' THEN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO person_phones_dirty (person_id)
+                SELECT DISTINCT person_id FROM new_rows WHERE person_id IS NOT NULL
+                ON CONFLICT DO NOTHING;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO person_phones_dirty (person_id)
+                SELECT DISTINCT person_id FROM old_rows WHERE person_id IS NOT NULL
+                ON CONFLICT DO NOTHING;
+            END IF;
+        ELSIF TG_OP = 'UPDATE' THEN
+            INSERT INTO person_phones_dirty (person_id)
+            SELECT id FROM old_rows UNION SELECT id FROM new_rows
+            ON CONFLICT DO NOTHING;
+        ELSE
+            INSERT INTO person_phones_dirty (person_id)
+            SELECT id FROM old_rows
+            ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION person_phones_truncate() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+    BEGIN
+        TRUNCATE person_phones, person_phones_dirty;
+        RETURN NULL;
+    END;
+    $$;
+    """,
+    # Transition tables allow a single event per trigger, hence one trigger per table and event
+    "DROP TRIGGER IF EXISTS phones_read_model_insert ON phones;",
+    """
+    CREATE TRIGGER phones_read_model_insert AFTER INSERT ON phones
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION person_phones_mark_dirty();
+    """,
+    "DROP TRIGGER IF EXISTS phones_read_model_update ON phones;",
+    """
+    CREATE TRIGGER phones_read_model_update AFTER UPDATE ON phones
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION person_phones_mark_dirty();
+    """,
+    "DROP TRIGGER IF EXISTS phones_read_model_delete ON phones;",
+    """
+    CREATE TRIGGER phones_read_model_delete AFTER DELETE ON phones
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION person_phones_mark_dirty();
+    """,
+    "DROP TRIGGER IF EXISTS persons_read_model_update ON persons;",
+    """
+    CREATE TRIGGER persons_read_model_update AFTER UPDATE ON persons
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION person_phones_mark_dirty();
+    """,
+    "DROP TRIGGER IF EXISTS persons_read_model_delete ON persons;",
+    """
+    CREATE TRIGGER persons_read_model_delete AFTER DELETE ON persons
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION person_phones_mark_dirty();
+    """,
+    "DROP TRIGGER IF EXISTS persons_read_model_truncate ON persons;",
+    """
+    CREATE TRIGGER persons_read_model_truncate AFTER TRUNCATE ON persons
+    FOR EACH STATEMENT EXECUTE FUNCTION person_phones_truncate();
+    """,
+    "DROP TRIGGER IF EXISTS phones_read_model_truncate ON phones;",
+    """
+    CREATE TRIGGER phones_read_model_truncate AFTER TRUNCATE ON phones
+    FOR EACH STATEMENT EXECUTE FUNCTION person_phones_truncate();
+    """,
+    # Rows that predate the triggers
+    "INSERT INTO person_phones_dirty (person_id) SELECT DISTINCT person_id FROM phones WHERE person_id IS NOT NULL ON CONFLICT DO NOTHING;",
+]
+
+CLAIM_DIRTY_QUERY = """
+    DELETE FROM person_phones_dirty
+    WHERE person_id IN (
+        SELECT person_id FROM person_phones_dirty
+        ORDER BY person_id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING person_id
+"""
+
+REBUILD_QUERIES = [
+    "DELETE FROM person_phones WHERE id = ANY(%(ids)s)",
+    "INSERT INTO person_phones " + PERSON_PHONES_SELECT + " WHERE p.id = ANY(%(ids)s) GROUP BY p.id",
+]
+
+FULL_REBUILD_QUERIES = [
+    "LOCK TABLE persons, phones IN SHARE MODE",
+    "TRUNCATE person_phones, person_phones_dirty",
+    "INSERT INTO person_phones " + PERSON_PHONES_SELECT + " GROUP BY p.id",
+]
+
+LOG_REFRESH_QUERY = "INSERT INTO person_phones_refreshes (kind, persons, duration_ms) VALUES (%s, %s, %s)"
+
+REPORT_QUERY = """
+    SELECT
+        (SELECT count(*) FROM person_phones),
+        (SELECT count(*) FROM person_phones_dirty),
+        (SELECT EXTRACT(EPOCH FROM clock_timestamp() - min(changed_at)) FROM person_phones_dirty),
+        last.refreshed_at, last.kind, last.persons, last.duration_ms,
+        recent.refreshes, recent.persons, recent.duration_ms
+    FROM (SELECT 1) one
+    LEFT JOIN LATERAL (
+        SELECT * FROM person_phones_refreshes ORDER BY refreshed_at DESC LIMIT 1
+    ) last ON true
+    CROSS JOIN LATERAL (
+        SELECT count(*) AS refreshes, sum(persons) AS persons, sum(duration_ms) AS duration_ms
+        FROM person_phones_refreshes
+        WHERE refreshed_at > clock_timestamp() - interval '1 hour'
+    ) recent
+"""
+
+STALENESS_QUERY = "SELECT EXTRACT(EPOCH FROM clock_timestamp() - min(changed_at)) FROM person_phones_dirty"
+
+
+def load_read_model_config():
+    return load_settings(READ_MODEL_DEFAULTS, 'read_model')
+
+
+def refresh(batch_size=None, full=False, config=load_config()):
+    """ Apply pending changes to person_phones, or rebuild it entirely; returns the persons rebuilt """
+    batch_size = batch_size or load_read_model_config()['batch_size']
+    pool = get_pool(config)
+    start = time.perf_counter()
+    rebuilt = 0
+    if full:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                for query in FULL_REBUILD_QUERIES:
+                    timed_execute(cur, query, config=config)
+                rebuilt = cur.rowcount
+                timed_execute(cur, LOG_REFRESH_QUERY, ('full', rebuilt, (time.perf_counter() - start) * 1000), config)
+        return rebuilt
+
+    while True:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                timed_execute(cur, CLAIM_DIRTY_QUERY, (batch_size,), config)
+                ids = [row[0] for row in cur.fetchall()]
+                if not ids:
+                    break
+                for query in REBUILD_QUERIES:
+                    timed_execute(cur, query, {'ids': ids}, config)
+        rebuilt += len(ids)
+    if rebuilt:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                timed_execute(
+                    cur, LOG_REFRESH_QUERY, ('incremental', rebuilt, (time.perf_counter() - start) * 1000), config
+                )
+    return rebuilt
+
+
+def staleness(config=load_config()):
+    """ Seconds since the oldest change not yet applied to person_phones, or None when it is current """
+    with get_pool(config).connection() as conn:
+        with conn.cursor() as cur:
+            timed_execute(cur, STALENESS_QUERY, config=config)
+            return cur.fetchone()[0]
+
+
+def ensure_fresh(max_staleness_s=None, config=load_config()):
+    """ Refresh first if pending changes are older than max_staleness_s """
+    if max_staleness_s is None:
+        max_staleness_s = load_read_model_config()['max_staleness_s']
+    if max_staleness_s < 0:
+        return 0
+    lag = staleness(config)
+    if lag is not None and lag >= max_staleness_s:
+        return refresh(config=config)
+    return 0
+
+
+def report(config=load_config()):
+    with get_pool(config).connection() as conn:
+        with conn.cursor() as cur:
+            timed_execute(cur, REPORT_QUERY, config=config)
+            (
+                persons, dirty, lag, refreshed_at, kind, last_persons, last_ms,
+                recent_refreshes, recent_persons, recent_ms
+            ) = cur.fetchone()
+    return {
+        'persons': persons,
+        'pending_persons': dirty,
+        'staleness_s': float(lag) if lag is not None else 0.0,
+        'last_refresh': {
+            'at': refreshed_at.isoformat() if refreshed_at else None,
+            'kind': kind,
+            'persons': last_persons,
+            'duration_ms': last_ms,
+        },
+        'last_hour': {
+            'refreshes': recent_refreshes,
+            'persons': recent_persons or 0,
+            'duration_ms': recent_ms or 0.0,
+            'persons_per_sec': recent_persons / recent_ms * 1000 if recent_ms else 0.0,
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the person_phones read model')
+    parser.add_argument('command', choices=('report', 'refresh'))
+    parser.add_argument('--full', action='store_true', help='rebuild every row instead of pending ones')
+    parser.add_argument('--batch-size', type=int)
+    cli_args = parser.parse_args()
+
+    if cli_args.command == 'refresh':
+        print(f'Rebuilt {refresh(cli_args.batch_size, cli_args.full)} persons')
+    print(report())
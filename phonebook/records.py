@@ -0,0 +1,63 @@
+""" Typed result records for the select modes.
+
+Records are namedtuples: column-name access with no per-instance __dict__, so they cost no more
+than the plain tuples the cursors return. Joined ALL/PhN rows are folded into one PersonPhones
+per person, so the person columns are held once instead of once per phone, and first and second
+names, which repeat across many persons, are interned so equal names share one string.
+"""
+import sys
+from collections import namedtuple
+from itertools import groupby
+
+Person = namedtuple('Person', 'id first_name second_name username')
+Phone = namedtuple('Phone', 'phone_id phone person_id phone_normalized')
+PersonPhones = namedtuple('PersonPhones', 'person phones')
+
+PERSON_WIDTH = len(Person._fields)
+
+# Row order that records() relies on: joined rows of one person must be adjacent
+RECORD_ORDER = {
+    'ALL': 'ORDER BY id, phone_id',
+    'PaN': 'ORDER BY id',
+    'PhN': 'ORDER BY id, phone_id',
+    'SurN': 'ORDER BY id',
+    'PwP': 'ORDER BY id',
+}
+
+
+def make_person(row):
+    person_id, first_name, second_name, username = row[:PERSON_WIDTH]
+    return Person(person_id, sys.intern(first_name), sys.intern(second_name), username)
+
+
+def make_phone(row, person_id):
+    phone_id, phone, _, phone_normalized = row[PERSON_WIDTH:]
+    # Share objects the row already holds: the person's id, and the phone when it is stored normalized
+    return Phone(phone_id, phone, person_id, phone if phone == phone_normalized else phone_normalized)
+
+
+def group_phones(rows):
+    """ Fold joined persons+phones rows, ordered by person id, into PersonPhones records """
+    for _, person_rows in groupby(rows, key=lambda row: row[0]):
+        person_rows = list(person_rows)
+        person = make_person(person_rows[0])
+        yield PersonPhones(person, tuple(make_phone(row, person.id) for row in person_rows))
+
+
+def unpack_phones(row):
+    """ PersonPhones from a person row followed by phone_id, phone and phone_normalized arrays """
+    person = make_person(row)
+    phone_ids, phones, phones_normalized = row[PERSON_WIDTH:]
+    return PersonPhones(person, tuple(
+        Phone(phone_id, phone, person.id, phone if phone == phone_normalized else phone_normalized)
+        for phone_id, phone, phone_normalized in zip(phone_ids, phones, phones_normalized)
+    ))
+
+
+def to_records(mode, rows):
+    """ Lazily map a select mode's rows to Person records, or PersonPhones for the joined modes """
+    if mode in ('ALL', 'PhN'):
+        return group_phones(rows)
+    if mode == 'PwP':
+        return map(unpack_phones, rows)
+    return map(make_person, rows)
@@ -0,0 +1,51 @@
+from config import load_config
+from pool import get_pool
+from instrumentation import timed_execute
+
+SEARCH_LIMIT = 10
+
+SEARCH_INDEXES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+    "CREATE INDEX IF NOT EXISTS persons_first_name_trgm_idx ON persons USING GIN (first_name gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS persons_second_name_trgm_idx ON persons USING GIN (second_name gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS persons_second_name_idx ON persons (second_name);",
+    "CREATE INDEX IF NOT EXISTS phones_person_id_idx ON phones (person_id);",
+]
+
+SEARCH_QUERY = """
+    SELECT p.id, p.first_name, p.second_name, p.username, p.rank, COALESCE(ph.phones, '{}') AS phones
+    FROM (
+        SELECT id, first_name, second_name, username,
+               GREATEST(similarity(first_name, %(term)s), similarity(second_name, %(term)s)) AS rank
+        FROM persons
+        WHERE first_name ILIKE %(pattern)s OR second_name ILIKE %(pattern)s
+        ORDER BY rank DESC, id
+        LIMIT %(limit)s
+    ) p
+    LEFT JOIN LATERAL (
+        SELECT array_agg(phone ORDER BY phone_id) AS phones
+        FROM phones
+        WHERE person_id = p.id
+    ) ph ON true
+    ORDER BY p.rank DESC, p.id
+"""
+
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_persons(term, limit=SEARCH_LIMIT, prefix=False, config=load_config()):
+    """ Return the top `limit` persons whose first or second name contains (or starts with) `term`,
+        ranked by trigram similarity, each with an array of their phones """
+    pattern = escape_like(term) + '%'
+    if not prefix:
+        pattern = '%' + pattern
+    with get_pool(config).connection() as conn:
+        with conn.cursor() as cur:
+            timed_execute(cur, SEARCH_QUERY, {'term': term, 'pattern': pattern, 'limit': limit}, config)
+            return cur.fetchall()
+
+
+def autocomplete(prefix, limit=SEARCH_LIMIT, config=load_config()):
+    return search_persons(prefix, limit, prefix=True, config=config)
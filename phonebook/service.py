@@ -0,0 +1,354 @@
+""" HTTP/JSON service over the phonebook storage backend.
+
+Identical lookups and searches that arrive while one is already running wait for its result instead
+of querying again, and POST /users requests arriving within batch_wait_ms of each other are inserted
+together by one multi-row statement. Host, port and batching come from the optional [service] section.
+
+    GET    /persons?mode=ALL|PaN|PhN|SurN|PwP&value=..&limit=100[&after=key | &offset=n]
+    GET    /lookup/phone/<phone>, /lookup/surname/<surname>
+    GET    /search?q=..[&limit=20][&prefix=1]
+    GET    /stats
+    POST   /persons, /phones, /users          {"first_name": .., "second_name": .., "username": .., "phone": ..}
+    PATCH  /persons/<id>, /phones/<id>        {"first_name": ..} / {"phone": .., "person_id": ..}
+    DELETE /persons/<id>, /phones/<id>
+    POST   /procedures/<UU|DD|IM>             {"args": [..]}
+
+Person pages are ordered by person id, then phone id; pass a page's "after" value back as after= to get
+the next one. A person whose phones straddle a page boundary is split between the two pages.
+
+Usage: python service.py [--host 127.0.0.1] [--port 8080]
+"""
+import argparse
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import psycopg2
+from config import load_config, load_settings
+from main import get_backend, PostgresBackend, pool_stats
+from search import SEARCH_LIMIT, search_persons
+from storage import SELECT_MODES, row_key
+from records import PersonPhones, to_records
+from cache import lookup_cache, InvalidationError
+from instrumentation import metrics as query_metrics
+
+SERVICE_DEFAULTS = {
+    'host': '127.0.0.1',
+    'port': 8080,
+    'batch_size': 500,
+    'batch_wait_ms': 5.0,
+    'page_limit': 100,
+}
+
+
+def load_service_config():
+    return load_settings(SERVICE_DEFAULTS, 'service')
+
+
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class CoalescerStats:
+    calls: int = 0
+    executed: int = 0
+    coalesced: int = 0
+
+
+class Coalescer:
+    """ Run concurrent calls with the same key once, handing the one result to every caller """
+
+    def __init__(self):
+        self.stats = CoalescerStats()
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, func):
+        with self._lock:
+            self.stats.calls += 1
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.stats.executed += 1
+            else:
+                self.stats.coalesced += 1
+        if leader:
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._calls[key]
+        return future.result()
+
+
+@dataclass
+class BatcherStats:
+    submitted: int = 0
+    batches: int = 0
+    max_batch: int = 0
+    fallbacks: int = 0
+    invalidation_errors: int = 0
+
+
+class InsertBatcher:
+    """ Collect items submitted from many threads and pass them to flush() in batches.
+
+    A batch is flushed once it holds max_batch items or max_wait seconds after its first item.
+    When a batch fails its items are retried one by one, so one bad item fails only its own caller.
+    An InvalidationError means the batch was committed, so it is reported and never retried.
+    """
+
+    def __init__(self, flush, max_batch=500, max_wait=0.005):
+        self.flush = flush
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = BatcherStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='insert-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while (entry := self._queue.get()) is not None:
+            batch = [entry]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    entry = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    self._flush(batch)
+                    return
+                batch.append(entry)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        self.stats.submitted += len(batch)
+        self.stats.batches += 1
+        self.stats.max_batch = max(self.stats.max_batch, len(batch))
+        try:
+            self._call([item for item, _ in batch])
+        except Exception:
+            self.stats.fallbacks += 1
+            for item, future in batch:
+                try:
+                    future.set_result(self._call([item]))
+                except Exception as e:
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                future.set_result(1)
+
+    def _call(self, items):
+        try:
+            return self.flush(items)
+        except InvalidationError as e:
+            self.stats.invalidation_errors += 1
+            print(f'Inserted {len(items)} items, but {e}')
+            return len(items)
+
+
+def record_json(record):
+    if isinstance(record, PersonPhones):
+        return {**record.person._asdict(), 'phones': [phone._asdict() for phone in record.phones]}
+    return record._asdict()
+
+
+def require(body, *fields):
+    missing = [name for name in fields if not body.get(name)]
+    if missing:
+        raise HttpError(400, f"Missing fields: {', '.join(missing)}")
+    return [body[name] for name in fields]
+
+
+class PhonebookService:
+
+    def __init__(self, backend, settings=SERVICE_DEFAULTS, config=load_config()):
+        self.backend = backend
+        self.config = config
+        self.settings = settings
+        self.coalescer = Coalescer()
+        self.batcher = InsertBatcher(
+            backend.insert_users, settings['batch_size'], settings['batch_wait_ms'] / 1000
+        )
+        self.routes = [
+            ('GET', r'/persons', self.list_persons),
+            ('GET', r'/lookup/(?P<kind>phone|surname)/(?P<value>[^/]+)', self.lookup),
+            ('GET', r'/search', self.search),
+            ('GET', r'/stats', self.stats),
+            ('POST', r'/persons', self.insert_person),
+            ('POST', r'/phones', self.insert_phone),
+            ('POST', r'/users', self.insert_user),
+            ('PATCH', r'/persons/(?P<person_id>\d+)', self.update_person),
+            ('PATCH', r'/phones/(?P<phone_id>\d+)', self.update_phone),
+            ('DELETE', r'/persons/(?P<person_id>\d+)', self.delete_person),
+            ('DELETE', r'/phones/(?P<phone_id>\d+)', self.delete_phone),
+            ('POST', r'/procedures/(?P<name>UU|DD|IM)', self.call_procedure),
+        ]
+
+    def dispatch(self, method, path, params, body):
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                return handler(params, body, **{key: unquote(value) for key, value in match.groupdict().items()})
+        raise HttpError(404, f'No route for {method} {path}')
+
+    def list_persons(self, params, body):
+        mode = params.get('mode', 'ALL')
+        if mode not in SELECT_MODES:
+            raise HttpError(400, f'Unknown mode {mode!r}')
+        limit = int(params.get('limit', self.settings['page_limit']))
+        offset = int(params['offset']) if 'offset' in params else None
+        after = tuple(int(part) for part in params['after'].split(',')) if 'after' in params else None
+        pages = self.backend.paginate(mode, limit, params.get('value'), offset=offset, after=after)
+        page = next(pages, [])
+        pages.close()
+        return {
+            'records': [record_json(record) for record in to_records(mode, page)],
+            'after': ','.join(map(str, row_key(mode, page[-1]))) if len(page) == limit else None,
+        }
+
+    def lookup(self, params, body, kind, value):
+        mode = 'PhN' if kind == 'phone' else 'SurN'
+        records = self.coalescer.call((mode, value), lambda: list(self.backend.records(mode, value)))
+        return {'records': [record_json(record) for record in records]}
+
+    def search(self, params, body):
+        if not isinstance(self.backend, PostgresBackend):
+            raise HttpError(501, 'Search needs the PostgreSQL backend')
+        term = params.get('q', '')
+        limit = int(params.get('limit', SEARCH_LIMIT))
+        prefix = params.get('prefix') in ('1', 'true')
+        rows = self.coalescer.call(
+            ('search', term, limit, prefix), lambda: search_persons(term, limit, prefix, config=self.config)
+        )
+        return {'results': [
+            {'id': person_id, 'first_name': first_name, 'second_name': second_name, 'username': username,
+             'rank': rank, 'phones': phones}
+            for person_id, first_name, second_name, username, rank, phones in rows
+        ]}
+
+    def stats(self, params, body):
+        return {
+            'coalescer': asdict(self.coalescer.stats),
+            'batcher': asdict(self.batcher.stats),
+            'cache': lookup_cache.stats.snapshot(),
+            'pools': pool_stats(),
+            'queries': query_metrics.snapshot(),
+        }
+
+    def insert_person(self, params, body):
+        return {'id': self.backend.insert_person(*require(body, 'first_name', 'second_name', 'username'))}
+
+    def insert_phone(self, params, body):
+        return {'phone_id': self.backend.insert_phone(*require(body, 'phone', 'person_id'))}
+
+    def insert_user(self, params, body):
+        user = tuple(require(body, 'first_name', 'second_name', 'username', 'phone'))
+        return {'inserted': self.batcher.submit(user)}
+
+    def update_person(self, params, body, person_id):
+        updated = self.backend.update_person(
+            int(person_id), body.get('first_name'), body.get('second_name'), body.get('username')
+        )
+        return {'updated': updated}
+
+    def update_phone(self, params, body, phone_id):
+        (phone,) = require(body, 'phone')
+        return {'updated': self.backend.update_phone(int(phone_id), phone, body.get('person_id'))}
+
+    def delete_person(self, params, body, person_id):
+        return {'deleted': self.backend.delete_person(int(person_id))}
+
+    def delete_phone(self, params, body, phone_id):
+        return {'deleted': self.backend.delete_phone(int(phone_id))}
+
+    def call_procedure(self, params, body, name):
+        args = body.get('args') or []
+        if name == 'IM':
+            args = [tuple(user) for user in args]
+        return {'result': self.backend.call_procedure(name, args)}
+
+    def close(self):
+        self.batcher.stop()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else {}
+            status, payload = 200, self.service.dispatch(self.command, url.path, params, body)
+        except HttpError as e:
+            status, payload = e.status, {'error': str(e)}
+        except (psycopg2.IntegrityError, sqlite3.IntegrityError) as e:
+            status, payload = 409, {'error': str(e).strip()}
+        except (ValueError, TypeError) as e:
+            status, payload = 400, {'error': str(e)}
+        except Exception as e:
+            status, payload = 500, {'error': str(e)}
+
+        data = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PATCH = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host=None, port=None, config=load_config()):
+    settings = load_service_config()
+    backend = get_backend(config)
+    backend.init()
+    service = PhonebookService(backend, settings, config)
+    handler = type('PhonebookRequestHandler', (RequestHandler,), {'service': service})
+    server = ThreadingHTTPServer((host or settings['host'], port or settings['port']), handler)
+    print(f'Serving the phonebook on http://{server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the phonebook over HTTP/JSON')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    cli_args = parser.parse_args()
+
+    serve(cli_args.host, cli_args.port)
@@ -0,0 +1,290 @@
+import contextlib
+import csv
+import json
+import sqlite3
+import threading
+import time
+
+from storage import StorageBackend, SELECT_MODES, keyset_seek, row_key
+from phone_normalization import normalize_phone
+from records import RECORD_ORDER
+from bulk_import import ImportReport, IMPORT_COLUMNS, CHUNK_SIZE, read_chunks
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS persons (
+        id INTEGER PRIMARY KEY,
+        first_name VARCHAR(35) NOT NULL,
+        second_name VARCHAR(35) NOT NULL,
+        username VARCHAR(35) NOT NULL UNIQUE
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS phones (
+        phone_id INTEGER PRIMARY KEY,
+        phone VARCHAR(20) NOT NULL UNIQUE,
+        person_id INTEGER,
+        phone_normalized VARCHAR(20) UNIQUE,
+        FOREIGN KEY (person_id)
+        REFERENCES persons (id)
+        ON UPDATE CASCADE ON DELETE CASCADE
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS persons_first_name_idx ON persons (first_name);",
+    "CREATE INDEX IF NOT EXISTS persons_second_name_idx ON persons (second_name);",
+    "CREATE INDEX IF NOT EXISTS phones_person_id_idx ON phones (person_id);",
+]
+
+# Aggregated from a subquery ordered by phone_id, so each array lists phones in the PostgreSQL read model's order
+PERSON_PHONES_QUERY = """
+    SELECT id, first_name, second_name, username,
+           json_group_array(phone_id), json_group_array(phone), json_group_array(phone_normalized)
+    FROM (
+        SELECT p.id, p.first_name, p.second_name, p.username, ph.phone_id, ph.phone, ph.phone_normalized
+        FROM persons p
+        JOIN phones ph ON ph.person_id = p.id
+        WHERE {seek}
+        ORDER BY p.id, ph.phone_id
+    )
+    GROUP BY id
+"""
+
+SELECT_QUERIES = {
+    'ALL': "SELECT * FROM persons JOIN phones on persons.id = phones.person_id",
+    'PaN': "SELECT * FROM persons WHERE first_name LIKE ?",
+    'PhN': """
+        SELECT * FROM persons
+        JOIN phones on persons.id = phones.person_id
+        WHERE phone_normalized = ?
+    """,
+    'SurN': "SELECT * FROM persons WHERE second_name = ?",
+    # No read model here: persons with their phones are aggregated on every read
+    'PwP': PERSON_PHONES_QUERY.format(seek='TRUE'),
+}
+
+# SELECT_QUERIES with room for a storage.keyset_seek() predicate and the key order, for keyset pages.
+# phones_person_id_idx ends in the rowid, phone_id, so it serves the joined modes' (id, phone_id) order
+KEYSET_QUERIES = {
+    'ALL': SELECT_QUERIES['ALL'] + ' WHERE {seek} ORDER BY persons.id, phones.phone_id',
+    'PaN': SELECT_QUERIES['PaN'] + ' AND {seek} ORDER BY id',
+    'PhN': SELECT_QUERIES['PhN'] + ' AND {seek} ORDER BY persons.id, phones.phone_id',
+    'SurN': SELECT_QUERIES['SurN'] + ' AND {seek} ORDER BY id',
+    'PwP': PERSON_PHONES_QUERY + ' ORDER BY id',
+}
+
+STREAM_ITERSIZE = 2000
+
+INSERT_PHONE_FOR_USERNAME = """
+    INSERT INTO phones (phone, phone_normalized, person_id)
+    SELECT ?, ?, id FROM persons WHERE username = ?
+"""
+
+
+def connect(path, **kwargs):
+    """ Open a connection with the PRAGMAs every phonebook connection relies on """
+    conn = sqlite3.connect(path, **kwargs)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA foreign_keys = ON')
+    # Match PostgreSQL, where LIKE is case sensitive
+    conn.execute('PRAGMA case_sensitive_like = ON')
+    return conn
+
+
+def decode_rows(mode, rows):
+    """ Turn the JSON arrays of PwP rows into lists, matching the PostgreSQL array columns """
+    if mode != 'PwP':
+        return rows
+    return [(*row[:4], *map(json.loads, row[4:])) for row in rows]
+
+
+def select_args(mode, value):
+    if mode not in SELECT_MODES:
+        raise ValueError(f'Unknown select mode {mode!r}')
+    if mode == 'PaN':
+        return (f'%{value}%',)
+    if mode == 'PhN':
+        return (normalize_phone(value),)
+    if mode == 'SurN':
+        return (value,)
+    return ()
+
+
+class SqliteBackend(StorageBackend):
+    """ Embedded single-file storage: WAL journal, one shared connection guarded by a lock """
+
+    def __init__(self, path='phonebook.db'):
+        self.path = path
+        self.conn = connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+
+    def execute(self, query, args=(), many=False):
+        with self.lock, self.conn:
+            cur = self.conn.executemany(query, args) if many else self.conn.execute(query, args)
+            return cur.fetchall(), cur.rowcount, cur.lastrowid
+
+    def init(self):
+        with self.lock, self.conn:
+            for command in SCHEMA:
+                self.conn.execute(command)
+
+    def reset(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM phones')
+            self.conn.execute('DELETE FROM persons')
+
+    def insert_person(self, first_name, second_name, username):
+        query = 'INSERT INTO persons (first_name, second_name, username) VALUES (?, ?, ?)'
+        return self.execute(query, (first_name, second_name, username))[2]
+
+    def insert_phone(self, phone, person_id):
+        query = 'INSERT INTO phones (phone, phone_normalized, person_id) VALUES (?, ?, ?)'
+        return self.execute(query, (phone, normalize_phone(phone), person_id))[2]
+
+    def insert_users(self, users):
+        users = list(users)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT INTO persons (first_name, second_name, username) VALUES (?, ?, ?)',
+                [(first_name, second_name, username) for first_name, second_name, username, _ in users]
+            )
+            cur = self.conn.executemany(
+                INSERT_PHONE_FOR_USERNAME,
+                [(phone, normalize_phone(phone), username) for _, _, username, phone in users]
+            )
+            return cur.rowcount
+
+    def copy_csv(self, csv_path, table_type='person'):
+        with open(csv_path, 'r', newline='') as f:
+            reader = csv.reader(f)
+            next(reader)  # Skip header
+            if table_type == 'person':
+                query = 'INSERT INTO persons (first_name, second_name, username) VALUES (?, ?, ?)'
+                rows = reader
+            else:
+                query = 'INSERT INTO phones (phone, phone_normalized, person_id) VALUES (?, ?, ?)'
+                rows = ((phone, normalize_phone(phone), person_id) for phone, person_id in reader)
+            self.execute(query, rows, many=True)
+
+    def import_csv(self, csv_path, chunk_size=CHUNK_SIZE, rejects_path=None):
+        report = ImportReport(rejects_path=rejects_path or csv_path + '.rejected.csv')
+        start = time.perf_counter()
+        with open(csv_path, 'r', newline='') as f, open(report.rejects_path, 'w', newline='') as rejects_file:
+            rejects = csv.writer(rejects_file)
+            rejects.writerow(('line_no', *IMPORT_COLUMNS, 'reason'))
+            for staged, rejected in read_chunks(f, chunk_size):
+                report.chunks += 1
+                report.rows_read += len(staged) + len(rejected)
+                with self.lock, self.conn:
+                    for line_no, first_name, second_name, username, phone in staged:
+                        # Like bulk_import, a row with a taken phone is rejected before its person is written
+                        normalized = normalize_phone(phone)
+                        if self.conn.execute('SELECT 1 FROM phones WHERE phone_normalized = ?', (normalized,)).fetchone():
+                            rejected.append((line_no, first_name, second_name, username, phone, 'duplicate phone'))
+                            continue
+                        self.conn.execute(
+                            """
+                            INSERT INTO persons (first_name, second_name, username) VALUES (?, ?, ?)
+                            ON CONFLICT (username) DO UPDATE
+                            SET first_name = excluded.first_name, second_name = excluded.second_name
+                            """,
+                            (first_name, second_name, username)
+                        )
+                        self.conn.execute(INSERT_PHONE_FOR_USERNAME, (phone, normalized, username))
+                rejects.writerows(sorted(rejected))
+                report.rows_rejected += len(rejected)
+        report.rows_imported = report.rows_read - report.rows_rejected
+        report.elapsed = time.perf_counter() - start
+        return report
+
+    def update_person(self, person_id, first_name=None, second_name=None, username=None):
+        values = {'first_name': first_name, 'second_name': second_name, 'username': username}
+        columns = [column for column, value in values.items() if value]
+        if not columns:
+            return 0
+        query = f"UPDATE persons SET {', '.join(f'{column} = ?' for column in columns)} WHERE id = ?"
+        return self.execute(query, [values[column] for column in columns] + [person_id])[1]
+
+    def update_phone(self, phone_id, phone, person_id=None):
+        updates = ['phone = ?', 'phone_normalized = ?']
+        args = [phone, normalize_phone(phone)]
+        if person_id:
+            updates.append('person_id = ?')
+            args.append(person_id)
+        query = f"UPDATE phones SET {', '.join(updates)} WHERE phone_id = ?"
+        return self.execute(query, args + [phone_id])[1]
+
+    def delete_person(self, person_id):
+        return self.execute('DELETE FROM persons WHERE id = ?', (person_id,))[1]
+
+    def delete_phone(self, phone_id):
+        return self.execute('DELETE FROM phones WHERE phone_id = ?', (phone_id,))[1]
+
+    def select(self, mode, value=None):
+        return decode_rows(mode, self.execute(SELECT_QUERIES[mode], select_args(mode, value))[0])
+
+    def paginate(self, mode, limit, value=None, offset=None, after=None):
+        args = select_args(mode, value)
+        if offset is not None:
+            query = f'{SELECT_QUERIES[mode]} {RECORD_ORDER[mode]} LIMIT ? OFFSET ?'
+            while page := self.execute(query, args + (limit, offset))[0]:
+                yield decode_rows(mode, page)
+                offset += limit
+            return
+
+        last_key = None if after is None else tuple(after)
+        while True:
+            seek, seek_args = keyset_seek(mode, last_key, placeholder='?')
+            page = self.execute(KEYSET_QUERIES[mode].format(seek=seek) + ' LIMIT ?', args + seek_args + (limit,))[0]
+            if not page:
+                break
+            yield decode_rows(mode, page)
+            last_key = row_key(mode, page[-1])
+
+    def stream(self, mode, value=None, itersize=None, ordered=False):
+        query = SELECT_QUERIES[mode] + (' ' + RECORD_ORDER[mode] if ordered else '')
+        # A dedicated read connection: sqlite3 cursors step lazily, and WAL lets writers continue meanwhile.
+        # Each connection to an in-memory database gets a new, empty one, so those read through the
+        # backend's own connection, taking the lock per fetch
+        shared = self.path in ('', ':memory:')
+        conn = self.conn if shared else connect(self.path)
+        lock = self.lock if shared else contextlib.nullcontext()
+        try:
+            with lock:
+                cur = conn.execute(query, select_args(mode, value))
+            while True:
+                with lock:
+                    rows = cur.fetchmany(itersize or STREAM_ITERSIZE)
+                if not rows:
+                    break
+                yield from decode_rows(mode, rows)
+        finally:
+            if not shared:
+                conn.close()
+
+    def call_procedure(self, name, args):
+        if name == 'IM':
+            return self.insert_users(args)
+        if name == 'UU':
+            first_name, second_name, username, phone = args
+            found = self.execute(
+                'SELECT id FROM persons WHERE first_name = ? AND second_name = ?', (first_name, second_name)
+            )[0]
+            if not found:
+                self.insert_users([(first_name, second_name, username, phone)])
+            return
+        if name == 'DD':
+            method, first_name, phone = args
+            if method == 'ph' and phone:
+                return self.execute(
+                    'DELETE FROM persons WHERE id IN (SELECT person_id FROM phones WHERE phone_normalized = ?)',
+                    (normalize_phone(phone),)
+                )[1]
+            if method == 'fn' and first_name:
+                return self.execute('DELETE FROM persons WHERE first_name = ?', (first_name,))[1]
+            print('INVALID INPUT')
+            return
+        raise ValueError(f'Unknown procedure {name!r}')
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,118 @@
+from abc import ABC, abstractmethod
+
+from config import load_settings
+from records import to_records
+
+STORAGE_DEFAULTS = {
+    'backend': 'postgresql',
+    'sqlite_path': 'phonebook.db',
+}
+SELECT_MODES = ('ALL', 'PaN', 'PhN', 'SurN', 'PwP')
+
+
+def load_storage_config():
+    """ Read the backend choice from the optional [storage] section """
+    return load_settings(STORAGE_DEFAULTS, 'storage')
+
+
+def key_columns(mode):
+    """ Columns that uniquely order the rows of a select mode, used for keyset pagination.
+        Joined rows are keyed by person first, so a person's phones stay adjacent as records need """
+    return ('id', 'phone_id') if mode in ('ALL', 'PhN') else ('id',)
+
+
+def row_key(mode, row):
+    """ The key_columns(mode) values of a row """
+    return (row[0], row[4]) if mode in ('ALL', 'PhN') else (row[0],)
+
+
+def keyset_seek(mode, last_key, placeholder='%s'):
+    """ A predicate selecting the rows after last_key, a key_columns(mode) tuple, and its args.
+        It goes inside the base query, on the tables' own key columns, so an index can start each page
+        at the key; the joined modes spell out the (id, phone_id) comparison for phones (person_id, phone_id) """
+    if last_key is None:
+        return 'TRUE', ()
+    if mode in ('ALL', 'PhN'):
+        person_id, phone_id = last_key
+        seek = f'persons.id >= {placeholder} AND (persons.id > {placeholder} OR phones.phone_id > {placeholder})'
+        return seek, (person_id, person_id, phone_id)
+    return f'id > {placeholder}', tuple(last_key)
+
+
+class StorageBackend(ABC):
+    """ Operations behind the phonebook menu, implemented once per storage engine.
+
+    Select modes are the select_data ones (ALL, PaN, PhN, SurN, PwP). ALL and PhN rows are
+    persons columns followed by phones columns; PaN and SurN rows are persons columns; PwP rows
+    are persons columns followed by lists of phone_id, phone and phone_normalized, one row per
+    person with phones.
+    """
+
+    @abstractmethod
+    def init(self):
+        pass
+
+    @abstractmethod
+    def reset(self):
+        """ Remove every person and phone and restart ids at 1 """
+
+    @abstractmethod
+    def insert_person(self, first_name, second_name, username):
+        pass
+
+    @abstractmethod
+    def insert_phone(self, phone, person_id):
+        pass
+
+    @abstractmethod
+    def insert_users(self, users):
+        """ Insert (first_name, second_name, username, phone) tuples; returns the number inserted """
+
+    @abstractmethod
+    def copy_csv(self, csv_path, table_type='person'):
+        """ Load a persons.csv or phones.csv layout file as-is """
+
+    @abstractmethod
+    def import_csv(self, csv_path):
+        """ Validating import of a combined persons+phones CSV; returns a bulk_import.ImportReport """
+
+    @abstractmethod
+    def update_person(self, person_id, first_name=None, second_name=None, username=None):
+        pass
+
+    @abstractmethod
+    def update_phone(self, phone_id, phone, person_id=None):
+        pass
+
+    @abstractmethod
+    def delete_person(self, person_id):
+        pass
+
+    @abstractmethod
+    def delete_phone(self, phone_id):
+        pass
+
+    @abstractmethod
+    def select(self, mode, value=None):
+        pass
+
+    @abstractmethod
+    def paginate(self, mode, limit, value=None, offset=None, after=None):
+        """ Yield pages of a select mode; keyset pagination unless an offset is given,
+            starting after `after`, a tuple of key_columns(mode) values, when one is given """
+
+    @abstractmethod
+    def stream(self, mode, value=None, itersize=None, ordered=False):
+        """ Yield rows of a select mode without materializing the whole result; itersize is rows per fetch.
+            ordered=True sorts by records.RECORD_ORDER """
+
+    def records(self, mode, value=None, itersize=None):
+        """ Lazily yield records.Person, or records.PersonPhones for the joined modes """
+        return to_records(mode, self.stream(mode, value, itersize, ordered=True))
+
+    @abstractmethod
+    def call_procedure(self, name, args):
+        """ Run one of the procedure_queries operations (UU, DD, IM) """
+
+    def close(self):
+        pass
@@ -1,4 +1,5 @@
 import psycopg2
+import psycopg2.extras
 from config import load_config
 
 
@@ -21,7 +22,134 @@ def database_init(config=load_config()):
             REFERENCES users (id)
             ON UPDATE CASCADE ON DELETE CASCADE
         );
+        """,
+        # One-off, before the unique index exists: keep only each user's best progress row, the latest
+        # among equals, so it can be built. Older rows of a user's score history are dropped for good
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_indexes
+                WHERE tablename = 'user_scores' AND indexname = 'user_scores_user_id_key'
+            ) THEN
+                DELETE FROM user_scores
+                WHERE score_id IN (
+                    SELECT score_id FROM (
+                        SELECT score_id, row_number() OVER (
+                            PARTITION BY user_id ORDER BY score DESC, COALESCE(level, 1) DESC, score_id DESC
+                        ) AS position
+                        FROM user_scores
+                        WHERE user_id IS NOT NULL
+                    ) ranked
+                    WHERE position > 1
+                );
+                CREATE UNIQUE INDEX user_scores_user_id_key ON user_scores (user_id);
+            END IF;
+        END;
+        $$;
+        """,
+        # The no-op DO UPDATEs make RETURNING yield the existing rows too, even ones inserted
+        # by a concurrent login that this statement's snapshot cannot see
+        """
+        CREATE OR REPLACE FUNCTION login_user(login VARCHAR(35))
+        RETURNS TABLE (id INTEGER, username VARCHAR(35), score INTEGER, level INTEGER)
+        LANGUAGE sql
+        AS $$
+            WITH account AS (
+                INSERT INTO users (username) VALUES (login)
+                ON CONFLICT (username) DO UPDATE SET username = EXCLUDED.username
+                RETURNING users.id, users.username
+            ), progress AS (
+                INSERT INTO user_scores (user_id)
+                SELECT account.id FROM account
+                ON CONFLICT (user_id) DO UPDATE SET user_id = EXCLUDED.user_id
+                RETURNING user_scores.score, user_scores.level
+            )
+            SELECT account.id, account.username, progress.score, progress.level
+            FROM account, progress
+        $$;
+        """,
+        # Redundant with the unique user_id index
+        "DROP INDEX IF EXISTS user_scores_user_id_score_idx;",
+        "CREATE INDEX IF NOT EXISTS user_scores_score_idx ON user_scores (score DESC);",
+        "CREATE INDEX IF NOT EXISTS user_scores_level_score_idx ON user_scores (level, score DESC);",
+        # Players per (level, score): a player's rank is one plus the players above them, summed over
+        # a few hundred rows here instead of counting millions of user_scores rows
         """
+        CREATE TABLE IF NOT EXISTS score_counts (
+            level INTEGER NOT NULL,
+            score INTEGER NOT NULL,
+            players BIGINT NOT NULL,
+            PRIMARY KEY (level, score)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS score_counts_score_idx ON score_counts (score);",
+        """
+        CREATE OR REPLACE FUNCTION score_counts_apply() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' THEN
+                -- Only rows whose bucket changed: login_user's no-op upsert rewrites every login's row,
+                -- and touching the hot (1, 0) bucket for it would make concurrent logins queue on its lock
+                UPDATE score_counts SET players = score_counts.players - removed.players
+                FROM (
+                    SELECT COALESCE(old_rows.level, 1) AS level, old_rows.score, count(*) AS players
+                    FROM old_rows JOIN new_rows ON new_rows.score_id = old_rows.score_id
+                    WHERE (COALESCE(old_rows.level, 1), old_rows.score)
+                        IS DISTINCT FROM (COALESCE(new_rows.level, 1), new_rows.score)
+                    GROUP BY 1, 2
+                ) removed
+                WHERE score_counts.level = removed.level AND score_counts.score = removed.score;
+
+                INSERT INTO score_counts (level, score, players)
+                SELECT COALESCE(new_rows.level, 1), new_rows.score, count(*)
+                FROM new_rows JOIN old_rows ON old_rows.score_id = new_rows.score_id
+                WHERE (COALESCE(old_rows.level, 1), old_rows.score)
+                    IS DISTINCT FROM (COALESCE(new_rows.level, 1), new_rows.score)
+                GROUP BY 1, 2
+                ON CONFLICT (level, score) DO UPDATE SET players = score_counts.players + EXCLUDED.players;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE score_counts SET players = score_counts.players - removed.players
+                FROM (
+                    SELECT COALESCE(level, 1) AS level, score, count(*) AS players
+                    FROM old_rows GROUP BY 1, 2
+                ) removed
+                WHERE score_counts.level = removed.level AND score_counts.score = removed.score;
+            ELSE
+                INSERT INTO score_counts (level, score, players)
+                SELECT COALESCE(level, 1), score, count(*) FROM new_rows GROUP BY 1, 2
+                ON CONFLICT (level, score) DO UPDATE SET players = score_counts.players + EXCLUDED.players;
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+        """,
+        "DROP TRIGGER IF EXISTS user_scores_counts_insert ON user_scores;",
+        """
+        CREATE TRIGGER user_scores_counts_insert AFTER INSERT ON user_scores
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION score_counts_apply();
+        """,
+        "DROP TRIGGER IF EXISTS user_scores_counts_update ON user_scores;",
+        """
+        CREATE TRIGGER user_scores_counts_update AFTER UPDATE ON user_scores
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION score_counts_apply();
+        """,
+        "DROP TRIGGER IF EXISTS user_scores_counts_delete ON user_scores;",
+        """
+        CREATE TRIGGER user_scores_counts_delete AFTER DELETE ON user_scores
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION score_counts_apply();
+        """,
+        # Scores saved before the counts existed
+        """
+        INSERT INTO score_counts (level, score, players)
+        SELECT COALESCE(level, 1), score, count(*) FROM user_scores
+        WHERE NOT EXISTS (SELECT 1 FROM score_counts)
+        GROUP BY 1, 2;
+        """,
     ]
 
     try:
@@ -67,6 +195,7 @@ def add_score(user_id, score):
     query = """
         INSERT INTO user_scores (user_id, score) 
         VALUES (%s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET score = EXCLUDED.score
     """
     execute_wrapper(query, user_id, score, fetchable=False)
 
@@ -82,13 +211,57 @@ def get_user_scores(user_id, limit=10):
     return execute_wrapper(query, user_id, limit)
 
 
+def get_top_scores(limit=10, level=None):
+    """ (rank, username, score, level) of the best scores, overall or on one level """
+    query = """
+        SELECT rank() OVER (ORDER BY user_scores.score DESC), users.username, user_scores.score, user_scores.level
+        FROM user_scores
+        JOIN users ON users.id = user_scores.user_id
+        {where}
+        ORDER BY user_scores.score DESC
+        LIMIT %s
+    """
+    if level is None:
+        return execute_wrapper(query.format(where=''), limit)
+    return execute_wrapper(query.format(where='WHERE user_scores.level = %s'), level, limit)
+
+
+def get_player_rank(user_id):
+    """ (rank, level_rank, players, score, level) of the user, or None before their first save """
+    query = """
+        SELECT
+            1 + COALESCE((SELECT sum(players) FROM score_counts WHERE score > mine.score), 0),
+            1 + COALESCE((SELECT sum(players) FROM score_counts WHERE level = mine.level AND score > mine.score), 0),
+            (SELECT sum(players) FROM score_counts),
+            mine.score,
+            mine.level
+        FROM (SELECT score, COALESCE(level, 1) AS level FROM user_scores WHERE user_id = %s) mine
+    """
+    result = execute_wrapper(query, user_id)
+    return result[0] if result else None
+
+
 def update_user_score(user_id, new_score, new_level):
     query = """
         UPDATE user_scores
         SET score = %s, level = %s
         WHERE user_id = %s
     """
-    execute_wrapper(query, user_id, new_score, new_level, fetchable=False, commit=False)
+    execute_wrapper(query, new_score, new_level, user_id, fetchable=False)
+
+
+def update_user_scores(rows):
+    """ rows are (user_id, score, level); all of them are written by one statement """
+    query = """
+        UPDATE user_scores
+        SET score = data.score, level = data.level
+        FROM (VALUES %s) AS data (user_id, score, level)
+        WHERE user_scores.user_id = data.user_id
+    """
+    with psycopg2.connect(**config) as conn:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, query, rows, page_size=len(rows))
+        conn.commit()
 
 
 def get_user_data(username):
@@ -101,6 +274,11 @@ def get_user_data(username):
     return execute_wrapper(query, username)
 
 
+def login_user(username):
+    """ Return (id, username, score, level) of the user, creating them on first login, in one round trip """
+    return execute_wrapper('SELECT * FROM login_user(%s)', username)[0]
+
+
 def delete_user(user_id):
     query = 'DELETE FROM users WHERE id = %s'
     execute_wrapper(query, user_id, fetchable=False)
\ No newline at end of file
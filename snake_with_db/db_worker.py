@@ -0,0 +1,120 @@
+import atexit
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+from db_manager import update_user_scores
+
+FLUSH_INTERVAL = 1.0
+MAX_BATCH = 100
+MAX_BACKOFF = 30.0
+CLOSE_TIMEOUT = 5.0
+
+
+@dataclass
+class WorkerStats:
+    calls: int = 0
+    saves: int = 0
+    flushes: int = 0
+    rows_written: int = 0
+    failures: int = 0
+
+
+class DBWorker:
+    """ Runs database work off the game loop.
+
+    save_progress() only records the latest score and level per user; the worker writes all recorded
+    users in one statement every flush_interval seconds, so a slow or unreachable database never
+    stalls a frame. submit() runs any other db_manager call on the worker, after pending saves, and
+    returns a Future.
+    Failed flushes keep their rows (newer saves win) and are retried with exponential backoff.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_batch=MAX_BATCH):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.stats = WorkerStats()
+        self._pending = {}
+        self._calls = []
+        self._closing = False
+        self._failures = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='db-worker', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.close)
+        return self
+
+    def save_progress(self, user_id, score, level):
+        with self._cond:
+            self._pending[user_id] = (score, level)
+            self.stats.saves += 1
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify()
+
+    def submit(self, func, *args):
+        future = Future()
+        with self._cond:
+            self._calls.append((func, args, future))
+            self._cond.notify()
+        return future
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """ Write whatever is still pending and stop the worker """
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _due(self):
+        return self._calls or self._closing or len(self._pending) >= self.max_batch
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            with self._cond:
+                self._cond.wait_for(self._due, timeout=max(0.0, next_flush - time.monotonic()))
+                calls, self._calls = self._calls, []
+                closing = self._closing
+                # Calls flush first, so that reads submitted after a save see it
+                flush = (calls or closing or len(self._pending) >= self.max_batch
+                         or time.monotonic() >= next_flush)
+                rows, self._pending = (self._pending, {}) if flush else ({}, self._pending)
+
+            if flush:
+                next_flush = time.monotonic() + self._write(rows)
+
+            for func, args, future in calls:
+                self.stats.calls += 1
+                try:
+                    future.set_result(func(*args))
+                except Exception as e:
+                    future.set_exception(e)
+
+            if closing:
+                break
+
+    def _write(self, rows):
+        """ Write rows in one statement and return the delay until the next flush """
+        if not rows:
+            return self.flush_interval
+        try:
+            update_user_scores([(user_id, score, level) for user_id, (score, level) in rows.items()])
+        except Exception as e:
+            self.stats.failures += 1
+            self._failures += 1
+            with self._cond:
+                for user_id, progress in rows.items():
+                    self._pending.setdefault(user_id, progress)
+                if self._closing:
+                    print(f'Could not save progress of {len(self._pending)} users: {e}')
+            return min(self.flush_interval * 2 ** self._failures, MAX_BACKOFF)
+        self.stats.flushes += 1
+        self.stats.rows_written += len(rows)
+        self._failures = 0
+        return self.flush_interval
@@ -0,0 +1,43 @@
+import time
+
+from db_manager import get_top_scores, get_player_rank
+
+LEADERBOARD_TTL = 5.0
+TOP_LIMIT = 10
+
+
+class Leaderboard:
+    """ Leaderboard queries cached for ttl seconds and refreshed through the db worker.
+
+    Getters never block: they return the cached result (None until the first one arrives) and,
+    once it is older than ttl, start a single background refresh, so a scene can call them every frame.
+    """
+
+    def __init__(self, db_worker, ttl=LEADERBOARD_TTL):
+        self.db_worker = db_worker
+        self.ttl = ttl
+        self._entries = {}
+        self._loading = {}
+
+    def _get(self, key, func, *args):
+        loading = self._loading.get(key)
+        if loading is not None and loading.done():
+            del self._loading[key]
+            # After a failure keep serving the old result and retry only after another ttl
+            value = self._entries.get(key, (0.0, None))[1] if loading.exception() else loading.result()
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            loading = None
+
+        expires, value = self._entries.get(key, (0.0, None))
+        if loading is None and time.monotonic() >= expires:
+            self._loading[key] = self.db_worker.submit(func, *args)
+        return value
+
+    def top(self, limit=TOP_LIMIT, level=None):
+        return self._get(('top', limit, level), get_top_scores, limit, level)
+
+    def player_rank(self, user_id):
+        return self._get(('rank', user_id), get_player_rank, user_id)
+
+    def invalidate(self):
+        self._entries.clear()
@@ -2,8 +2,11 @@ import pygame, sys
 import random
 import time
 from functools import partial
-from db_manager import database_init, get_user_data, add_user, add_score, update_user_score
+from db_manager import database_init, login_user
+from db_worker import DBWorker
+from leaderboard import Leaderboard
 from objects import UserObject
+from snake_body import SnakeBody, BODY_POINT_SIZE
 from abc import ABC, abstractmethod
 
 pygame.init()
@@ -23,6 +26,10 @@ SCREEN_HEIGHT = 600
 INIT_SCORE = 0
 INIT_LEVEL = 1
 SNAKE_INITIAL_LENGTH = 75
+# Gameplay pushes only the screen regions that changed to the display; False repaints every frame
+DIRTY_RECT_RENDERING = True
+SCORE_POSITION = (SCREEN_WIDTH - 30, 10)
+LEVEL_POSITION = (30, 10)
 
 DISPLAYSURF = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
 pygame.display.set_caption("Game")
@@ -49,9 +56,12 @@ pygame.time.set_timer(CREATE_FRUIT, 1500)
 
 font_small = pygame.font.SysFont("Verdana", 20)
 font = pygame.font.SysFont("Verdana", 60)
+font_menu = pygame.font.Font(None, 50)
 
 snakeHeadImage = pygame.image.load("snakeout.png")
 fruitImage = pygame.image.load("appleout.png")
+bodyImage = pygame.Surface((BODY_POINT_SIZE, BODY_POINT_SIZE))
+bodyImage.fill(GREEN)
 
 BASIC_BORDERS = [pygame.Rect(0, 0, SCREEN_WIDTH, 10),
                  pygame.Rect(0, 0, 10, SCREEN_HEIGHT),
@@ -106,6 +116,17 @@ LEVELS = [
 ]
 
 
+def render_level_background(borders):
+    background = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+    background.fill(BLACK)
+    for border in borders:
+        pygame.draw.rect(background, WHITE, border)
+    return background
+
+
+LEVEL_BACKGROUNDS = [render_level_background(borders) for borders in LEVELS]
+
+
 # Try to use State pattern
 class SnakeHead(pygame.sprite.Sprite):
 
@@ -138,10 +159,7 @@ class SnakeHead(pygame.sprite.Sprite):
                 self.current_state = 'RIGHT'
 
     def leave_point(self):
-        cur_center = self.rect.center
-        point = CollisionPoint(cur_center[0], cur_center[1], self.current_state)
-
-        return point
+        return self.rect.center
 
     def move(self):
         self.rect.move_ip(get_movement(self.current_state))
@@ -164,13 +182,36 @@ class Fruit(pygame.sprite.Sprite):
             self.kill()
 
 
-class CollisionPoint(pygame.sprite.Sprite):
-    def __init__(self, x, y, state):
-        super().__init__()
-        self.image = pygame.Surface((5, 5), pygame.SRCALPHA)  # Small point
-        self.image.fill((0, 255, 0, 255))
-        self.change_state = state
-        self.rect = self.image.get_rect(center=(x, y))
+class CachedText:
+    """ A rendered text that is rendered again only when its value changes """
+
+    def __init__(self, font, color, template='{}', topleft=(0, 0)):
+        self.font = font
+        self.color = color
+        self.template = template
+        self.topleft = topleft
+        self.value = None
+        self.surface = None
+        self.rect = pygame.Rect(topleft, (0, 0))
+
+    def set(self, value):
+        """ Returns whether the text was rendered again """
+        if self.surface is not None and value == self.value:
+            return False
+        self.value = value
+        self.surface = self.font.render(self.template.format(value), True, self.color)
+        self.rect = self.surface.get_rect(topleft=self.topleft)
+        return True
+
+
+def body_rect(point):
+    return pygame.Rect(point[0] - BODY_POINT_SIZE // 2, point[1] - BODY_POINT_SIZE // 2,
+                       BODY_POINT_SIZE, BODY_POINT_SIZE)
+
+
+def draw_body(screen, points):
+    offset = BODY_POINT_SIZE // 2
+    screen.blits([(bodyImage, (x - offset, y - offset)) for x, y in points], doreturn=False)
 
 
 def get_sign(n): return (n > 0) - (n < 0)
@@ -192,6 +233,9 @@ class Scene:
     def __init__(self, manager):
         self.manager = manager
 
+    def enter(self):
+        pass
+
     def handle_events(self, events):
         pass
 
@@ -199,14 +243,16 @@ class Scene:
         pass
 
     def draw(self, screen):
+        """ Returns the rects that changed, or None when the whole screen has to be shown """
         pass
 
 # Weak command pattern
 class SceneManager:
-    def __init__(self):
+    def __init__(self, db_worker):
         self.scenes = {}
         self.current_scene = None
         self.user_data = None
+        self.db_worker = db_worker
 
     def add_scene(self, name, scene):
         self.scenes[name] = scene
@@ -214,6 +260,7 @@ class SceneManager:
     def switch_scene(self, name):
         if name in self.scenes:
             self.current_scene = self.scenes[name]
+            self.current_scene.enter()
 
     def handle_events(self, events):
         if self.current_scene:
@@ -225,13 +272,15 @@ class SceneManager:
 
     def draw(self, screen):
         if self.current_scene:
-            self.current_scene.draw(screen)
+            return self.current_scene.draw(screen)
 
     def set_user_data(self, user_data):
         self.user_data = user_data
 
     def save_progress(self):
-        update_user_score(self.user_data.id, self.user_data.score, self.user_data.level)
+        # Only queues the write; the db worker flushes it in the background
+        if self.user_data:
+            self.db_worker.save_progress(self.user_data.id, self.user_data.score, self.user_data.level)
 
 
 class IUpdatable(ABC):
@@ -263,33 +312,45 @@ class StartMenu(Scene):
     def __init__(self, manager):
         super().__init__(manager)
         self.username = ""
+        self.login = None
+        self.error = None
+        self.label_text = CachedText(font_menu, (255, 255, 255), topleft=(150, 250))
+        self.username_text = CachedText(font_menu, (255, 255, 255), topleft=(175, 300))
 
     def handle_events(self, events):
         for event in events:
             if event.type == pygame.QUIT:
                 pygame.quit()
                 exit()
-            elif event.type == pygame.KEYDOWN:
+            elif event.type == pygame.KEYDOWN and self.login is None:
                 if event.key == pygame.K_RETURN and self.username:
-                    user_data = get_user_data(self.username)
-                    if not user_data:
-                        user_id = add_user(self.username)
-                        add_score(user_id, 0)
-                        user_data = get_user_data(self.username)
-                    self.manager.switch_scene("gameplay")
-                    self.manager.set_user_data(UserObject(*user_data[0]))
+                    self.error = None
+                    self.login = self.manager.db_worker.submit(login_user, self.username)
                 elif event.key == pygame.K_BACKSPACE:
                     self.username = self.username[:-1]
                 elif event.unicode.isalnum() and len(self.username) < 20:
                     self.username += event.unicode
 
+    def update(self):
+        if self.login is None or not self.login.done():
+            return
+        try:
+            user_data = self.login.result()
+        except Exception as e:
+            self.error = f'Login failed: {e}'
+        else:
+            self.manager.switch_scene("gameplay")
+            self.manager.set_user_data(UserObject(*user_data))
+        self.login = None
+
     def draw(self, screen):
         screen.fill((30, 30, 30))
-        font = pygame.font.Font(None, 50)
-        label_text = font.render("Input your username", True, (255, 255, 255))
-        username_text = font.render(self.username, True, (255, 255, 255)) # True enables anti-aliasing
-        screen.blit(label_text, (150, 250))
-        screen.blit(username_text, (175, 300))
+        self.label_text.set("Loading..." if self.login else "Input your username")
+        self.username_text.set(self.username)
+        screen.blit(self.label_text.surface, self.label_text.rect)
+        screen.blit(self.username_text.surface, self.username_text.rect)
+        if self.error:
+            screen.blit(font_small.render(self.error[:55], True, RED), (20, 360))
 
 
 class GameplayScene(Scene, IUpdatable):
@@ -297,16 +358,25 @@ class GameplayScene(Scene, IUpdatable):
         super().__init__(manager)
         self.S1 = SnakeHead(*DISPLAYSURF.get_rect().center)
         self.fruits = pygame.sprite.Group()
-        self.collision_points = pygame.sprite.Group()
-        self.bodyWindow = list()
+        self.body = SnakeBody(SNAKE_INITIAL_LENGTH)
         self.all_sprites = pygame.sprite.Group()
         self.all_sprites.add(self.S1)
+        self.score_text = CachedText(font_small, 'yellow', topleft=SCORE_POSITION)
+        self.level_text = CachedText(font_small, 'green', 'Level:{:<3}', topleft=LEVEL_POSITION)
+        # Head, fruit and text rects of the last frame, erased before the next one is drawn
+        self.drawn_rects = []
+        self.drawn_level = None
+
+    def enter(self):
+        # Another scene painted over the screen
+        self.drawn_level = None
 
     def handle_events(self, events):
         pressed = pygame.key.get_pressed()
         ctrl_held = pressed[pygame.K_LCTRL] or pressed[pygame.K_RCTRL]
         for event in events:              
             if event.type == pygame.QUIT:
+                self.manager.save_progress()
                 pygame.quit()
                 sys.exit()
             if event.type == pygame.KEYDOWN:
@@ -314,6 +384,9 @@ class GameplayScene(Scene, IUpdatable):
                     appState['PAUSED'] = not appState['PAUSED']
                 if event.key == pygame.K_s and ctrl_held:
                     self.manager.save_progress()
+                if event.key == pygame.K_l:
+                    self.manager.save_progress()
+                    self.manager.switch_scene('leaderboard')
             if event.type == CREATE_FRUIT and len(self.fruits) < 5:
                 fruit = Fruit()
                 self.fruits.add(fruit)
@@ -328,27 +401,23 @@ class GameplayScene(Scene, IUpdatable):
 
         self.S1.change_direction()
         self.S1.move()
-        col_point = self.S1.leave_point()
-        self.collision_points.add(col_point)
-        self.bodyWindow.append(col_point)
-
-        self.bodyWindow = self.bodyWindow[-appState.get('window_size'):]
+        # A paused head stands still; stacking points under it would end the game by self-collision
+        if not appState['PAUSED']:
+            self.body.push(self.S1.leave_point())
+        self.body.trim(appState.get('window_size'))
 
         if pygame.sprite.spritecollideany(self.S1, self.fruits):
             # self.manager.user_data['score'] += random.randint(1, 3)
             appState['window_size'] = self.manager.user_data.score*5 + SNAKE_INITIAL_LENGTH
         
-        for point in self.collision_points:
-            if point not in self.bodyWindow:
-                point.kill()
-
-        for collide_point in self.bodyWindow[:-50]:
-            if collide_point.rect.collidepoint(self.S1.rect.center):
-                game_over_handler()
+        if self.body.collides(*self.S1.rect.center):
+            game_over_handler()
 
+        scored = False
         for fruit in self.fruits:
             if pygame.sprite.collide_rect(fruit, self.S1):
                 self.manager.user_data.score += fruit.weight
+                scored = True
                 fruit.kill()
             fruit.update()
 
@@ -358,6 +427,8 @@ class GameplayScene(Scene, IUpdatable):
 
         LEVEL = self.manager.user_data.score // 10 + 1
         self.manager.user_data.level = LEVEL
+        if scored:
+            self.manager.save_progress()
 
         if self.manager.user_data.level > appState['prev_level']:
             appState['prev_level'] = LEVEL
@@ -368,28 +439,96 @@ class GameplayScene(Scene, IUpdatable):
         appState['speed'] = 0 if appState['PAUSED'] else LEVEL
 
     def draw(self, screen):
-        screen.fill('black')
-        screen.blit(self.S1.image, self.S1.rect)
+        """ Repaint only what moved or changed since the last frame on top of the level background.
+
+        Erased regions are restored from the level's pre-rendered background, borders included. Only
+        body points overlapping an erased region, the head or a new point are drawn again, looked up in
+        the body's occupancy grid, so the cost of a frame does not grow with the snake's length.
+        """
+        level = self.manager.user_data.level
+        background = LEVEL_BACKGROUNDS[level - 1]
+        added, expired = self.body.take_changes()
+        texts = [(self.score_text, self.score_text.rect, self.score_text.set(self.manager.user_data.score)),
+                 (self.level_text, self.level_text.rect, self.level_text.set(level))]
+        head = self.S1.rect.copy()
+        fruit_rects = [fruit.rect.copy() for fruit in self.fruits]
+
+        if not DIRTY_RECT_RENDERING or level != self.drawn_level:
+            screen.blit(background, (0, 0))
+            screen.blit(self.S1.image, head)
+            draw_body(screen, self.body)
+            self.fruits.draw(screen)
+            for text, _, _ in texts:
+                screen.blit(text.surface, text.rect)
+            self.drawn_level = level
+            self.drawn_rects = [head] + fruit_rects
+            return None
+
+        added_rects = [body_rect(point) for point in added]
+        erased = self.drawn_rects + [body_rect(point) for point in expired]
+        # Texts go on top, so one is redrawn when it changed or anything near it did; points reach past rects
+        near = [rect.inflate(2 * BODY_POINT_SIZE, 2 * BODY_POINT_SIZE)
+                for rect in erased + added_rects + [head] + fruit_rects]
+        texts = [(text, previous) for text, previous, changed in texts if changed or previous.collidelist(near) != -1]
+        erased += [previous for _, previous in texts]
+
+        for rect in erased:
+            screen.blit(background, rect, rect)
+        screen.blit(self.S1.image, head)
+        points = set()
+        for rect in erased + added_rects + [head]:
+            points |= self.body.points_near(rect)
+        draw_body(screen, points)
+        self.fruits.draw(screen)
+        for text, _ in texts:
+            screen.blit(text.surface, text.rect)
 
-        score = font_small.render(str(self.manager.user_data.score), True, 'yellow')
-        screen.blit(score, (SCREEN_WIDTH - 30, 10))
+        self.drawn_rects = [head] + fruit_rects
+        return (erased + self.drawn_rects + [body_rect(point) for point in points]
+                + [text.rect for text, _ in texts])
 
-        self.collision_points.draw(screen)
 
-        for point in self.collision_points:
-            if point not in self.bodyWindow:
-                point.kill()
+class LeaderboardScene(Scene):
+    def __init__(self, manager, leaderboard):
+        super().__init__(manager)
+        self.leaderboard = leaderboard
 
-        for collide_point in self.bodyWindow[:-50]:
-            if collide_point.rect.collidepoint(self.S1.rect.center):
-                game_over_handler()
-        self.fruits.draw(screen)
+    def enter(self):
+        # The progress saved on the way in is flushed before these queries run
+        self.leaderboard.invalidate()
 
-        for border in LEVELS[self.manager.user_data.level - 1]:
-            pygame.draw.rect(screen, WHITE, border)
+    def handle_events(self, events):
+        for event in events:
+            if event.type == pygame.QUIT:
+                self.manager.save_progress()
+                pygame.quit()
+                sys.exit()
+            if event.type == pygame.KEYDOWN and event.key in (pygame.K_l, pygame.K_ESCAPE):
+                self.manager.switch_scene('gameplay')
 
-        level_display = font_small.render(f"Level:{self.manager.user_data.level:<3}", True, 'green')
-        screen.blit(level_display, (30, 10))
+    def draw(self, screen):
+        user_data = self.manager.user_data
+        screen.fill((30, 30, 30))
+        screen.blit(font_small.render('Leaderboard (L or Esc to return)', True, WHITE), (20, 20))
+
+        columns = ((20, 'Top players', self.leaderboard.top()),
+                   (310, f'Level {user_data.level}', self.leaderboard.top(level=user_data.level)))
+        for left, title, rows in columns:
+            screen.blit(font_small.render(title, True, 'yellow'), (left, 70))
+            if rows is None:
+                screen.blit(font_small.render('Loading...', True, WHITE), (left, 100))
+                continue
+            for i, (rank, username, score, level) in enumerate(rows):
+                line = f'{rank:>3}. {username[:12]:<12} {score}'
+                screen.blit(font_small.render(line, True, GREEN if username == user_data.username else WHITE),
+                            (left, 100 + i * 26))
+
+        rank = self.leaderboard.player_rank(user_data.id)
+        if rank:
+            # Everything here is the stored row the ranks were computed from, not the in-game progress
+            overall, on_level, players, saved_score, saved_level = rank
+            text = f'You: #{overall} of {players} overall, #{on_level} on level {saved_level}, saved {saved_score}'
+            screen.blit(font_small.render(text, True, 'green'), (20, SCREEN_HEIGHT - 50))
 
 
 def game_over_handler(screen=DISPLAYSURF):
@@ -404,19 +543,25 @@ def game_over_handler(screen=DISPLAYSURF):
 
 if __name__ == "__main__":
     database_init()
-    scene_manager = SceneManager()
+    db_worker = DBWorker().start()
+    scene_manager = SceneManager(db_worker)
     scene_manager.add_scene('start_menu', StartMenu(scene_manager))
     scene_manager.add_scene('gameplay', GameplayScene(scene_manager))
+    scene_manager.add_scene('leaderboard', LeaderboardScene(scene_manager, Leaderboard(db_worker)))
     scene_manager.switch_scene('start_menu')
 
     while appState['RUN']:
         events = pygame.event.get()
         scene_manager.handle_events(events)
         scene_manager.update()
-        scene_manager.draw(DISPLAYSURF)
+        dirty = scene_manager.draw(DISPLAYSURF)
 
-        pygame.display.flip()
+        if dirty is None:
+            pygame.display.flip()
+        else:
+            pygame.display.update(dirty)
         FramePerSec.tick(FPS)
 
     # Save user data to database
     scene_manager.save_progress()
+    db_worker.close()
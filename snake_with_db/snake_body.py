@@ -0,0 +1,96 @@
+from collections import Counter
+
+# The newest body points sit under the head and never count as a self-collision
+SELF_COLLISION_GRACE = 50
+BODY_POINT_SIZE = 5
+
+
+class SnakeBody:
+    """ Points left by the head, oldest first, in a ring buffer: push and expire are O(1).
+
+    Every point except the newest `grace` is also counted in an occupancy grid keyed by pixel, so a
+    self-collision test probes the BODY_POINT_SIZE square around the head instead of scanning the body.
+    Drawing is left to the caller; this class needs no pygame.
+    """
+
+    def __init__(self, capacity=64, grace=SELF_COLLISION_GRACE):
+        self.grace = grace
+        self.points = [None] * capacity
+        self.start = 0
+        self.length = 0
+        self.occupied = Counter()
+        # Points pushed and expired since the last take_changes(), for dirty-rect rendering
+        self.added = []
+        self.expired = []
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        capacity = len(self.points)
+        for i in range(self.length):
+            yield self.points[(self.start + i) % capacity]
+
+    def _at(self, index):
+        return self.points[(self.start + index) % len(self.points)]
+
+    def _grow(self):
+        self.points = list(self) + [None] * len(self.points)
+        self.start = 0
+
+    def push(self, point):
+        if self.length == len(self.points):
+            self._grow()
+        self.points[(self.start + self.length) % len(self.points)] = point
+        self.length += 1
+        self.added.append(point)
+        if self.length > self.grace:
+            self.occupied[self._at(self.length - 1 - self.grace)] += 1
+
+    def trim(self, max_length):
+        while self.length > max_length:
+            if self.length > self.grace:
+                tail = self._at(0)
+                self.occupied[tail] -= 1
+                if not self.occupied[tail]:
+                    del self.occupied[tail]
+            self.expired.append(self._at(0))
+            self.start = (self.start + 1) % len(self.points)
+            self.length -= 1
+
+    def collides(self, x, y):
+        """ Whether an old enough body point's square contains (x, y) """
+        reach = BODY_POINT_SIZE // 2
+        occupied = self.occupied
+        return any(
+            (x + dx, y + dy) in occupied
+            for dx in range(-reach, reach + 1)
+            for dy in range(-reach, reach + 1)
+        )
+
+    def points_near(self, rect):
+        """ Points whose square overlaps rect, a (left, top, width, height) sequence such as a pygame.Rect.
+
+        Old points are found through the occupancy grid, probing the rect's pixels or walking the grid,
+        whichever is smaller; the newest `grace` points are not in the grid and are checked directly.
+        """
+        left, top, width, height = rect
+        reach = BODY_POINT_SIZE // 2
+        x0, y0 = left - reach, top - reach
+        x1, y1 = left + width + reach, top + height + reach
+        inside = lambda point: x0 <= point[0] < x1 and y0 <= point[1] < y1
+
+        recent = (self._at(i) for i in range(max(0, self.length - self.grace), self.length))
+        near = {point for point in recent if inside(point)}
+        occupied = self.occupied
+        if (x1 - x0) * (y1 - y0) > len(occupied):
+            near.update(point for point in occupied if inside(point))
+        else:
+            near.update((x, y) for x in range(x0, x1) for y in range(y0, y1) if (x, y) in occupied)
+        return near
+
+    def take_changes(self):
+        """ The points pushed and the points expired since the last call """
+        added, expired = self.added, self.expired
+        self.added, self.expired = [], []
+        return added, expired
@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+from snake_body import SnakeBody, BODY_POINT_SIZE
+
+
+def old_collides(window, x, y, grace):
+    """ The list-slice check SnakeBody replaced: 5x5 point rects, all but the newest `grace` """
+    reach = BODY_POINT_SIZE // 2
+    return any(abs(px - x) <= reach and abs(py - y) <= reach for px, py in window[:-grace])
+
+
+def test_push_keeps_order_across_growth():
+    body = SnakeBody(capacity=2, grace=0)
+    for i in range(9):
+        body.push((i, 0))
+    assert list(body) == [(i, 0) for i in range(9)]
+    assert len(body) == 9
+    assert len(body.points) == 16
+
+
+def test_trim_and_push_wrap_around_the_ring():
+    body = SnakeBody(capacity=4, grace=0)
+    for i in range(4):
+        body.push((i, 0))
+    body.trim(2)
+    body.push((4, 0))
+    body.push((5, 0))
+    # Both pushes went into the slots freed at the front, without growing
+    assert len(body.points) == 4
+    assert body.start == 2
+    assert list(body) == [(2, 0), (3, 0), (4, 0), (5, 0)]
+
+    # Growing while wrapped keeps the order
+    body.push((6, 0))
+    assert list(body) == [(2, 0), (3, 0), (4, 0), (5, 0), (6, 0)]
+    assert body.start == 0
+
+
+def test_occupancy_counts_only_points_past_the_grace_window():
+    body = SnakeBody(capacity=4, grace=2)
+    for point in [(0, 0), (1, 0), (1, 0), (3, 0)]:
+        body.push(point)
+    assert body.occupied == {(0, 0): 1, (1, 0): 1}
+    body.trim(1)
+    assert body.occupied == {}
+    assert list(body) == [(3, 0)]
+
+
+def test_take_changes_reports_and_resets():
+    body = SnakeBody(capacity=4, grace=0)
+    body.push((0, 0))
+    body.push((1, 0))
+    body.trim(1)
+    assert body.take_changes() == ([(0, 0), (1, 0)], [(0, 0)])
+    assert body.take_changes() == ([], [])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_collides_matches_the_list_slice_logic(seed):
+    rng = random.Random(seed)
+    grace = 50
+    body = SnakeBody(capacity=8, grace=grace)
+    window = []
+    for _ in range(3000):
+        point = (rng.randrange(40), rng.randrange(40))
+        body.push(point)
+        window.append(point)
+        length = rng.randrange(30, 300)
+        body.trim(length)
+        window = window[-length:]
+
+        assert list(body) == window
+        x, y = rng.randrange(40), rng.randrange(40)
+        assert body.collides(x, y) == old_collides(window, x, y, grace)
+
+
+@pytest.mark.parametrize('size', [(3, 4), (40, 30), (200, 150)])
+def test_points_near_matches_brute_force(size):
+    rng = random.Random(size[0])
+    body = SnakeBody(grace=10)
+    for _ in range(300):
+        body.push((rng.randrange(0, 120), rng.randrange(0, 90)))
+    body.trim(250)
+    reach = BODY_POINT_SIZE // 2
+    for _ in range(50):
+        left, top = rng.randrange(-10, 120), rng.randrange(-10, 90)
+        rect = (left, top) + size
+        expected = {
+            (x, y) for x, y in body
+            if x - reach < left + size[0] and left < x - reach + BODY_POINT_SIZE
+            and y - reach < top + size[1] and top < y - reach + BODY_POINT_SIZE
+        }
+        assert body.points_near(rect) == expected